@@ -0,0 +1,73 @@
+import numpy as np
+
+# Chooses which wells to sample, read and dilute each cycle, so that wells that will not have moved much by the
+# next cycle are left alone and save robot time, tips and media.
+#
+# The method still ticks every cycle_time, but each well has its own period, a whole number of ticks between
+# min_period and max_period (scalars or per-well arrays, in seconds). After a well is serviced, its period is
+# set to how long its culture, diluted by the controller's last output and growing at its estimated k, takes to
+# grow out of a band around setpoint, allowing for how far off past predictions of its OD have been. Wells that
+# grow fast, sit far from setpoint or predict badly come round every tick; steady ones wait up to max_period.
+#
+#   sampler = AdaptiveSampler(num_turbs, cycle_time, max_period=4*cycle_time)
+#   due = sampler.due(now)                          # boolean mask of wells to service this tick
+#   predicted = sampler.predict_od(controllers, now)
+#   outputs = controllers.step(None, readings, mask=due)
+#   sampler.serviced(due, readings, predicted, controllers, now)
+
+class AdaptiveSampler:
+    def __init__(self, n, cycle_time, min_period=None, max_period=None, band=.1, z=2.0, error_gain=.2,
+            init_error=.2):
+        self.n = n
+        self.cycle_time = cycle_time
+        self.min_period = cycle_time if min_period is None else min_period
+        self.max_period = 4*cycle_time if max_period is None else max_period
+        self.band = band # fraction above setpoint a well may drift before it is due
+        self.z = z # how many standard errors of OD prediction to allow for
+        self.error_gain = error_gain # weight of each new prediction error in the running error estimate
+        self.period = np.full(n, float(cycle_time))
+        self.last_service = np.full(n, -np.inf) # never serviced: due now
+        self.od_error = np.full(n, float(init_error)) # rms relative error of OD predictions
+
+    def due(self, now):
+        # a half tick of slack, so a well whose period is k ticks is serviced every k ticks despite jitter
+        return now - self.last_service >= self.period - self.cycle_time/2
+
+    def predict_od(self, controllers, now):
+        # OD expected now from the state of the controller bank: last OD, diluted by the last output, grown since
+        state = controllers.state
+        od_after_dilution = state['od']/(1 + np.asarray(state.get('output', 0.0)))
+        return od_after_dilution*np.exp((now - np.asarray(state['update_time']))/3600*state['k_estimate'])
+
+    def serviced(self, mask, od_meas, predicted, controllers, now):
+        # call after the controllers have stepped on the wells in mask
+        mask = np.asarray(mask, dtype=bool)
+        od_meas = np.asarray(od_meas, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_error = (od_meas - predicted)/predicted
+        seen = mask & np.isfinite(self.last_service) & np.isfinite(rel_error) # first reads have nothing to compare to
+        g = self.error_gain
+        self.od_error[seen] = np.sqrt((1 - g)*self.od_error[seen]**2 + g*rel_error[seen]**2)
+        self.last_service[mask] = now
+        self.period[mask] = self.next_period(controllers, now)[mask]
+
+    def next_period(self, controllers, now):
+        # time for the upper bound of each well's predicted OD to grow from where it is after dilution to the top
+        # of the band, rounded down to whole ticks
+        od_upper = self.predict_od(controllers, now)*(1 + self.z*self.od_error)
+        od_limit = np.asarray(controllers.setpoint)*(1 + self.band)
+        k = np.maximum(controllers.k_estimate, 1e-6)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            time_to_limit = np.log(od_limit/od_upper)/k*3600
+        time_to_limit = np.where(np.isfinite(time_to_limit), time_to_limit, 0)
+        period = np.clip(time_to_limit, self.min_period, self.max_period)
+        return np.maximum(np.floor(period/self.cycle_time), 1)*self.cycle_time
+
+    def get_state(self):
+        return {'period': self.period.copy(), 'last_service': self.last_service.copy(), 'od_error': self.od_error.copy()}
+
+    def set_state(self, state):
+        if len(state['period']) != self.n:
+            raise ValueError('Sampler state is for ' + str(len(state['period'])) + ' wells, not ' + str(self.n))
+        for key in ('period', 'last_service', 'od_error'):
+            setattr(self, key, np.array(state[key], dtype=float))
@@ -0,0 +1,184 @@
+import os
+import sys
+import hmac
+import json
+import socket
+import secrets
+import logging
+import threading
+import socketserver
+from collections import deque
+
+# Operator commands for a running method, over a TCP socket on localhost (the robot PCs run Windows, where
+# that is the one local socket every Python has). One command per line; each gets one line of JSON back.
+#
+#   pause                       hold the method at the next step boundary
+#   resume
+#   setpoint OD [WELL ...]      new setpoint for the given wells, or all of them
+#   skip WELL [WELL ...]        stop sampling and diluting these wells
+#   unskip WELL [WELL ...]
+#   status
+#
+# From another terminal: python control_channel.py pause [--port N]
+#
+# Anyone who can connect to the port could otherwise steer the method, so each connection must first send the
+# token the channel writes to method_local/control_<port>.token when it starts (readable only by the user running
+# the method, where the OS supports that), and deletes when it closes. send() and the command line above read it
+# from there.
+#
+# pause and resume take effect as soon as they arrive: steps waiting in wait_if_paused() wake on an Event,
+# nothing polls. The other commands are queued for the method to apply at the start of its next cycle, on its
+# own thread (see pop_commands()), so they never change controller state in the middle of a step.
+
+default_port = 47600
+token_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'method_local')
+queued_commands = 'setpoint', 'skip', 'unskip'
+
+class ControlChannel:
+    def __init__(self, num_wells, port=default_port, host='127.0.0.1'):
+        self.num_wells = num_wells
+        self.address = host, port
+        self.status = lambda: {} # the method replaces this with something that describes its state
+        self._running = threading.Event() # clear while paused
+        self._running.set()
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._server = None
+        self._token = None
+
+    def start(self):
+        channel = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                token = self.rfile.readline().decode(errors='replace').strip()
+                if not hmac.compare_digest(token.encode(), channel._token.encode()):
+                    logging.warning('Control channel: refused a connection from %s with a bad token',
+                            self.client_address[0])
+                    self.wfile.write((json.dumps({'ok': False, 'error': 'bad token'}) + '\n').encode())
+                    return
+                for line in self.rfile:
+                    reply = channel.handle(line.decode(errors='replace'))
+                    self.wfile.write((json.dumps(reply) + '\n').encode())
+        self._token = secrets.token_hex(16)
+        self._server = socketserver.ThreadingTCPServer(self.address, Handler)
+        self._server.daemon_threads = True
+        write_token(self.address[1], self._token)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logging.info('Control channel listening on %s:%d', *self.address)
+        return self
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.remove(token_path(self.address[1]))
+            except FileNotFoundError:
+                pass
+        self._running.set() # never leave anything waiting
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def paused(self):
+        return not self._running.is_set()
+
+    def wait_if_paused(self, where=''):
+        if self._running.is_set():
+            return
+        logging.info('PAUSED%s; waiting for resume', ' before ' + where if where else '')
+        self._running.wait()
+        logging.info('RESUMED')
+
+    def pop_commands(self):
+        # (command, args) for every queued command since the last call, oldest first
+        with self._lock:
+            commands = list(self._pending)
+            self._pending.clear()
+        return commands
+
+    def handle(self, line):
+        words = line.split()
+        if not words:
+            return {'ok': False, 'error': 'empty command'}
+        command, args = words[0].lower(), words[1:]
+        try:
+            if command == 'pause':
+                self._running.clear()
+                logging.info('Control channel: pause requested')
+            elif command == 'resume':
+                self._running.set()
+            elif command == 'status':
+                pass
+            elif command in queued_commands:
+                parsed = self._parse(command, args)
+                with self._lock:
+                    self._pending.append((command, parsed))
+                logging.info('Control channel: queued %s %s', command, parsed)
+            else:
+                return {'ok': False, 'error': 'unknown command ' + repr(command)}
+        except ValueError as e:
+            return {'ok': False, 'error': str(e)}
+        return dict(self.status(), ok=True, paused=self.paused(), queued=len(self._pending))
+
+    def _parse(self, command, args):
+        if command == 'setpoint':
+            if not args:
+                raise ValueError('setpoint needs an OD')
+            od = float(args[0])
+            if not 0 < od:
+                raise ValueError('setpoint must be positive')
+            return od, self._wells(args[1:]) or list(range(self.num_wells))
+        wells = self._wells(args)
+        if not wells:
+            raise ValueError(command + ' needs at least one well')
+        return wells
+
+    def _wells(self, args):
+        wells = [int(arg) for arg in args]
+        bad = [well for well in wells if not 0 <= well < self.num_wells]
+        if bad:
+            raise ValueError('no such wells ' + str(bad) + '; wells are 0 to ' + str(self.num_wells - 1))
+        return wells
+
+def token_path(port):
+    return os.path.join(token_dir, 'control_' + str(port) + '.token')
+
+def write_token(port, token):
+    os.makedirs(token_dir, exist_ok=True)
+    path = token_path(port)
+    if os.path.exists(path):
+        os.remove(path) # left by a run that did not close; the new file gets the mode below
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+
+def read_token(port):
+    with open(token_path(port)) as f:
+        return f.read().strip()
+
+def send(command, port=default_port, host='127.0.0.1', timeout=5):
+    token = read_token(port)
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall((token + '\n' + command.strip() + '\n').encode())
+        with conn.makefile() as replies:
+            return json.loads(replies.readline())
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    port = default_port
+    if '--port' in args:
+        port = int(args.pop(args.index('--port') + 1))
+        args.remove('--port')
+    if not args:
+        print('Usage: python control_channel.py pause|resume|status|setpoint OD [WELL ...]|skip WELL ...|unskip WELL ... [--port N]')
+        sys.exit(1)
+    try:
+        print(json.dumps(send(' '.join(args), port)))
+    except (ConnectionRefusedError, FileNotFoundError):
+        print('Nothing is listening on port', port, '- is the method running?')
+        sys.exit(1)
@@ -0,0 +1,274 @@
+import os
+import threading
+import itertools
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+import pyhamilton
+from od_calibration import load_calibration, well_index
+from pace_util import (INITIALIZE, PICKUP, EJECT, ASPIRATE, DISPENSE, ISWAP_GET, ISWAP_PLACE, HEPA,
+    WASH96_EMPTY, PICKUP96, EJECT96, ASPIRATE96, DISPENSE96)
+
+# In-process stand-ins for the robot, plate reader, pumps and shaker, for running the whole method with no
+# hardware. Every command takes a configurable time on a shared clock (use virtual_clock.ScaledClock to run
+# faster than real time), and each device does one thing at a time, like the real ones.
+#
+# Liquid is tracked through the robot: tracked labware holds a volume and an OD per well, channels carry
+# what they aspirate, and culture wells grow with the same model as util/turbsim.py (exponential growth at a
+# per-well rate, occasional large positive spikes in the measurement). The reader writes what is in the plate
+# out in the ClarioStar export format and returns it as a TwinPlateData, which has what the method uses of the
+# driver's PlateData, so the controllers see the cultures react to the media they are fed. Only pyhamilton is
+# needed; the reader, pump and shaker driver packages are not.
+#
+# Disposable tips that go back to their rack are followed too: a tip that aspirates from somewhere other than
+# where it aspirated before (another culture, or the media reservoir after a culture) raises TipReuseError, since
+# on the robot it would carry one liquid into the other.
+
+TwinPlateHeader = namedtuple('TwinPlateHeader', 'plate_ids time')
+TwinPlateData = namedtuple('TwinPlateData', 'path header')
+
+default_latencies = { # seconds per command
+    INITIALIZE: 60, HEPA: 2, WASH96_EMPTY: 45,
+    PICKUP: 9, EJECT: 7, ASPIRATE: 8, DISPENSE: 7,
+    ISWAP_GET: 15, ISWAP_PLACE: 15,
+    PICKUP96: 14, EJECT96: 12, ASPIRATE96: 12, DISPENSE96: 10,
+    'plate_out': 8, 'run_protocol': 45,
+    'shaker': 1, 'pump_prime': 60, 'bleach_clean': 240,
+}
+
+class TipReuseError(RuntimeError):
+    pass
+
+class TrackedLabware:
+    def __init__(self, labware, num_wells, volume=0.0, od=0.0, growth_k=0.0, floor_vol=0.0):
+        self.labware = labware
+        self.index = {labware.position_id(i): i for i in range(num_wells)}
+        self.volume = np.full(num_wells, volume, dtype=float) # uL
+        self.od = np.full(num_wells, od, dtype=float)
+        self.growth_k = np.broadcast_to(np.asarray(growth_k, dtype=float), (num_wells,)).copy() # hrs^-1
+        self.floor_vol = floor_vol # what is left behind by an aspiration at a fixed height
+
+    def grow(self, delta_time):
+        self.od *= np.exp(delta_time/3600*self.growth_k)
+
+    def take(self, idx, vol, fixed_height=False):
+        available = self.volume[idx] - (self.floor_vol if fixed_height else 0)
+        vol = min(vol, max(available, 0))
+        self.volume[idx] -= vol
+        return vol, self.od[idx]
+
+    def add(self, idx, vol, od):
+        total = self.volume[idx] + vol
+        if total > 0:
+            self.od[idx] = (self.od[idx]*self.volume[idx] + od*vol)/total
+        self.volume[idx] = total
+
+class DigitalTwin:
+    def __init__(self, clock, data_dir, latencies=None, seed=None, calibration=None):
+        self.clock = clock
+        # the reader reports absorbance that this calibration turns back into the true OD
+        self.calibration = load_calibration() if calibration is None else calibration
+        self.data_dir = data_dir
+        self.latencies = dict(default_latencies, **(latencies or {}))
+        self.rng = np.random.default_rng(seed)
+        self.labware = {} # layout name -> TrackedLabware
+        self.reader_site = None
+        self.plate_in_reader = None # layout name
+        self.last_update = clock.time()
+        self.lock = threading.Lock() # guards liquid state; devices run on different threads
+
+    def track(self, labware, num_wells, **well_state):
+        self.labware[labware.layout_name()] = TrackedLabware(labware, num_wells, **well_state)
+
+    def add_cultures(self, labware, num_wells, volume, od=.05, growth_k=None, floor_vol=None):
+        if growth_k is None:
+            growth_k = self.rng.uniform(.5, 1.0, num_wells)
+        self.track(labware, num_wells, volume=volume, od=od, growth_k=growth_k,
+                floor_vol=volume if floor_vol is None else floor_vol)
+
+    def update(self):
+        # grow everything up to now; call with self.lock held
+        now = self.clock.time()
+        for tracked in self.labware.values():
+            tracked.grow(now - self.last_update)
+        self.last_update = now
+
+    def well(self, position):
+        # 'layout name, position id' -> (TrackedLabware, idx), or (None, None) if that labware is not tracked
+        name, pos_id = (field.strip() for field in position.split(','))
+        tracked = self.labware.get(name)
+        if tracked is None:
+            return None, None
+        return tracked, tracked.index[pos_id]
+
+    def instruments(self, reader_site):
+        # reader_site is where the iSWAP puts plates to be read
+        self.reader_site = reader_site.layout_name()
+        return TwinHamiltonInterface(self), TwinClarioStar(self), TwinPumps(self), TwinShaker(self)
+
+class TwinDevice:
+    def __init__(self, twin):
+        self.twin = twin
+        self.busy = threading.Lock() # one command at a time
+        self.disabled = False
+
+    def take_time(self, latency_key):
+        with self.busy:
+            self.twin.clock.sleep(self.twin.latencies[latency_key])
+
+    def disable(self):
+        self.disabled = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class TwinHamiltonInterface(TwinDevice):
+    def __init__(self, twin):
+        super().__init__(twin)
+        self.ids = itertools.count()
+        self.sent = {}
+        self.tips = [False]*8
+        self.mounted = [None]*8 # rack position of the tip on each channel
+        self.tip_sources = {} # rack position -> where that tip has aspirated from, while it is kept for reuse
+        self.channels = [(0.0, 0.0)]*8 # (volume, od) held by each channel
+        self.head_96 = [(0.0, 0.0)]*96
+        self.gripped = None # layout name of the plate in the iSWAP
+
+    def set_log_dir(self, log_dir):
+        pass
+
+    def send_command(self, template, **cmd_dict):
+        cmd_id = next(self.ids)
+        self.sent[cmd_id] = template, cmd_dict
+        return cmd_id
+
+    def wait_on_response(self, cmd_id, timeout=60, raise_first_exception=False, **more_options):
+        template, cmd_dict = self.sent.pop(cmd_id)
+        self.take_time(template)
+        with self.twin.lock:
+            self.twin.update()
+            self.execute(template, cmd_dict)
+
+    def execute(self, template, cmd_dict):
+        if template in (PICKUP, EJECT):
+            channels = active_channels(cmd_dict['channelVariable'])
+            if template is PICKUP:
+                if any(self.tips[ch] for ch in channels):
+                    raise pyhamilton.TipPresentError('Twin: tips already on channels ' + str(channels))
+                for ch, position in zip(channels, cmd_dict['labwarePositions'].split(';')):
+                    self.tips[ch] = True
+                    self.mounted[ch] = position
+            else:
+                for ch in channels:
+                    if cmd_dict.get('useDefaultWaste'):
+                        self.tip_sources.pop(self.mounted[ch], None)
+                    self.tips[ch] = False
+                    self.mounted[ch] = None
+                    self.channels[ch] = 0.0, 0.0
+        elif template in (ASPIRATE, DISPENSE):
+            channels = active_channels(cmd_dict['channelVariable'])
+            if not all(self.tips[ch] for ch in channels):
+                raise pyhamilton.NoTipError('Twin: no tips on some of channels ' + str(channels))
+            positions = cmd_dict['labwarePositions'].split(';')
+            fixed_height = 'liquidHeight' in cmd_dict
+            for ch, position, vol in zip(channels, positions, cmd_dict['volumes']):
+                if template is ASPIRATE:
+                    self.check_tip_reuse(ch, position)
+                self.channels[ch] = self.move_liquid(template is ASPIRATE, self.channels[ch], position, vol, fixed_height)
+        elif template in (ASPIRATE96, DISPENSE96):
+            aspirating = template is ASPIRATE96
+            vol = cmd_dict['aspirateVolume' if aspirating else 'dispenseVolume']
+            for i, position in enumerate(cmd_dict['labwarePositions'].split(';')):
+                self.head_96[i] = self.move_liquid(aspirating, self.head_96[i], position, vol, False)
+        elif template is EJECT96:
+            self.head_96 = [(0.0, 0.0)]*96
+        elif template is ISWAP_GET:
+            self.gripped = cmd_dict['plateLabwarePositions'].split(',')[0].strip()
+        elif template is ISWAP_PLACE:
+            if cmd_dict['plateLabwarePositions'].split(',')[0].strip() == self.twin.reader_site:
+                self.twin.plate_in_reader = self.gripped
+            elif self.twin.plate_in_reader == self.gripped:
+                self.twin.plate_in_reader = None
+            self.gripped = None
+
+    def check_tip_reuse(self, ch, position):
+        source = self.tip_sources.setdefault(self.mounted[ch], position)
+        if source != position:
+            raise TipReuseError('Twin: tip from ' + str(self.mounted[ch]) + ' aspirated from ' + source
+                    + ' before and now from ' + position)
+
+    def move_liquid(self, aspirating, held, position, vol, fixed_height):
+        tracked, idx = self.twin.well(position)
+        held_vol, held_od = held
+        if aspirating:
+            taken, od = tracked.take(idx, vol, fixed_height) if tracked else (vol, 0.0) # untracked: media, bleach
+            total = held_vol + taken
+            return total, (held_vol*held_od + taken*od)/total if total else 0.0
+        vol = min(vol, held_vol)
+        if tracked:
+            tracked.add(idx, vol, held_od)
+        return held_vol - vol, held_od
+
+def active_channels(channel_pattern):
+    return [ch for ch, c in enumerate(channel_pattern[:8]) if c == '1']
+
+class TwinClarioStar(TwinDevice):
+    def plate_out(self, block=True):
+        self.take_time('plate_out')
+
+    def run_protocols(self, protocol_names, plate_id_1=None, **more_options):
+        plate_datas = []
+        for protocol_name in protocol_names:
+            self.take_time('run_protocol')
+            with self.twin.lock:
+                self.twin.update()
+                tracked = self.twin.labware[self.twin.plate_in_reader]
+                absorbance = self.absorbance(tracked)
+            now = datetime.fromtimestamp(self.twin.clock.time())
+            path = self.write_data(protocol_name, plate_id_1, tracked, absorbance, now)
+            plate_datas.append(TwinPlateData(path, TwinPlateHeader((plate_id_1 or '',), now)))
+        return plate_datas
+
+    def absorbance(self, tracked):
+        # same spikes as turbsim, as when clumps occlude the sensor, on top of the reader's own noise
+        spikes = 1/(1 + self.twin.rng.random(len(tracked.od))*10000)
+        od = np.where(tracked.volume > 0, tracked.od + spikes, 0)
+        rows, cols = well_index(tracked.labware, range(len(od)))
+        noise = self.twin.rng.normal(0, self.twin.calibration.noise, len(od))
+        return self.twin.calibration.to_absorbance_at(od, rows, cols) + noise
+
+    def write_data(self, protocol_name, plate_id, tracked, absorbance, now):
+        os.makedirs(self.twin.data_dir, exist_ok=True)
+        path = os.path.join(self.twin.data_dir, '_'.join((plate_id or 'plate', protocol_name, now.strftime('%y%m%d_%H%M'))) + '.csv')
+        lines = ['Testname: ' + protocol_name,
+                'Date: ' + now.strftime('%m/%d/%Y  Time: %I:%M:%S %p'),
+                'ID1: ' + str(plate_id or '') + '  ID2:   ID3: ',
+                'No. of Channels / Multichromatics: 1', 'No. of Cycles: 1', 'Configuration: Absorbance',
+                'Used filter settings and gain values:', '  1: 600nm                                          0/0',
+                'Focal height [mm]: -', 'End_of_header', '', 'Chromatic: 1', 'Cycle: 1', 'Time [s]: 0']
+        for pos_id, idx in sorted(tracked.index.items(), key=lambda item: (item[0][0], int(item[0][1:]))):
+            lines.append('{}{:02d}:\t    {:.4f}'.format(pos_id[0], int(pos_id[1:]), absorbance[idx]))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+class TwinPumps(TwinDevice):
+    def prime(self):
+        self.take_time('pump_prime')
+
+    def refill(self, seconds):
+        with self.busy:
+            self.twin.clock.sleep(seconds)
+
+    def bleach_clean(self):
+        self.take_time('bleach_clean')
+
+class TwinShaker(TwinDevice):
+    def start(self, speed):
+        self.take_time('shaker')
+
+    def stop(self):
+        self.take_time('shaker')
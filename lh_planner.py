@@ -0,0 +1,131 @@
+from collections import namedtuple
+from pace_util import tip_eject, aspirate, dispense
+
+# Plans liquid transfers as a short sequence of robot commands, estimates how long the robot will take
+# to run it, and runs it.
+#
+# A Transfer moves vol uL from one (labware, idx) position to another. Transfers that share a non-None
+# tip_group use the same tips: one pickup serves a contiguous run of them, and run_plan puts the tips back
+# where they came from, for the next plan with that group. Give transfers the same group only if the tips may
+# touch all of their liquids, e.g. one batch of cultures and its reader wells, or media dispensed from above
+# the culture. tip_group=None means fresh tips for every batch, ejected to waste. A position's idx may be a
+# ChannelRow, for troughs and other sites where each channel uses its own row of a column whichever well it
+# is serving.
+#
+# Transfers are spread over the channels in order, unless they have a slot: the index into usable_channels()
+# of the channel to use. Reused tips stay on the channel they were picked up on, so transfers that reuse tips
+# for a batch of wells, but only serve some of them each time, give every well a slot to keep it on its tip.
+
+Transfer = namedtuple('Transfer', 'src dst vol tip_group slot')
+Transfer.__new__.__defaults__ = (None, None)
+PlanStep = namedtuple('PlanStep', 'command args options')
+ChannelRow = namedtuple('ChannelRow', 'offset') # stands for well index offset + channel
+
+num_channels = 8
+disabled_channels = (5,) # the sixth channel is disabled in pace_util (hardware trouble)
+max_tip_vol = 985 # uL, largest volume to move in one aspirate
+
+# Rough seconds per command (fixed part, plus per uL for liquid moves). Calibrate from timing data.
+default_time_model = {
+    'tip_pick_up': (9.0, 0), 'tip_eject': (7.0, 0),
+    'aspirate': (7.0, .004), 'dispense': (6.0, .004),
+}
+
+def usable_channels():
+    return [ch for ch in range(num_channels) if ch not in disabled_channels]
+
+def channel_lists(items, slots=None):
+    # spread items over the usable channels, or put them on their slots -> per-channel list with None on idle
+    # channels
+    lists = [None]*num_channels
+    channels = usable_channels()
+    for i, item in enumerate(items):
+        lists[channels[i if slots is None else slots[i]]] = item
+    return lists
+
+def channel_positions(positions, slots=None):
+    lists = channel_lists(positions, slots)
+    return [pos if pos is None or not isinstance(pos[1], ChannelRow) else (pos[0], pos[1].offset + ch)
+            for ch, pos in enumerate(lists)]
+
+def split_transfers(transfers):
+    # drop empty transfers; split any that are bigger than a tip into several equal passes
+    for transfer in transfers:
+        if transfer.vol is None or transfer.vol <= 0:
+            continue
+        passes = -(-transfer.vol//max_tip_vol) # ceil
+        for _ in range(int(passes)):
+            yield transfer._replace(vol=transfer.vol/passes)
+
+def batch_transfers(run, batch_size):
+    # consecutive batches that fill the channels; a transfer whose slot is taken starts the next batch
+    batch = []
+    for transfer in run:
+        if len(batch) == batch_size or (transfer.slot is not None and any(t.slot == transfer.slot for t in batch)):
+            yield batch
+            batch = []
+        batch.append(transfer)
+    if batch:
+        yield batch
+
+def plan_transfers(transfers, aspirate_options=None, dispense_options=None):
+    '''
+    transfers: iterable of Transfer. Order is kept within a tip group.
+    Returns a list of PlanStep. 'tip_pick_up' steps carry the number of channels needed and the tip group;
+    the tips to use are chosen when the plan is run.
+    '''
+    aspirate_options = aspirate_options or {}
+    dispense_options = dispense_options or {}
+    transfers = list(split_transfers(transfers))
+    # contiguous runs of the same tip group, so reuse never reorders transfers
+    runs = []
+    for transfer in transfers:
+        if runs and runs[-1][0] == transfer.tip_group:
+            runs[-1][1].append(transfer)
+        else:
+            runs.append((transfer.tip_group, [transfer]))
+    plan = []
+    batch_size = len(usable_channels())
+    for tip_group, run in runs:
+        batches = list(batch_transfers(run, batch_size))
+        reuse = tip_group is not None
+        for i, batch in enumerate(batches):
+            if not reuse or i == 0:
+                plan.append(PlanStep('tip_pick_up', (len(batch), tip_group), {}))
+            slots = None if any(t.slot is None for t in batch) else [t.slot for t in batch]
+            vols = channel_lists([t.vol for t in batch], slots)
+            plan.append(PlanStep('aspirate', (channel_positions([t.src for t in batch], slots), vols), aspirate_options))
+            plan.append(PlanStep('dispense', (channel_positions([t.dst for t in batch], slots), vols), dispense_options))
+            if not reuse or i == len(batches) - 1:
+                plan.append(PlanStep('tip_eject', (), {}))
+    return plan
+
+def estimate_seconds(plan, time_model=default_time_model):
+    total = 0.0
+    for step in plan:
+        fixed, per_ul = time_model[step.command]
+        total += fixed
+        if step.command in ('aspirate', 'dispense'):
+            total += per_ul*max(v for v in step.args[1] if v is not None)
+    return total
+
+def run_plan(ham_int, plan, new_tips, return_tips=True):
+    '''
+    Carry out a plan. new_tips(tip_group) must pick up a set of tips for the group and return their positions,
+    like robot_method.new_tips. Tips with a group are ejected back where they came from (unless return_tips is
+    False), tips without one to waste.
+    '''
+    tip_poss = tip_group = None
+    for step in plan:
+        if step.command == 'tip_pick_up':
+            tip_group = step.args[1]
+            tip_poss = new_tips(tip_group)
+        elif step.command == 'tip_eject':
+            tip_eject(ham_int, tip_poss if return_tips and tip_group is not None else None)
+            tip_poss = tip_group = None
+        elif step.command == 'aspirate':
+            aspirate(ham_int, *step.args, **step.options)
+        elif step.command == 'dispense':
+            dispense(ham_int, *step.args, **step.options)
+        else:
+            raise ValueError('Unknown plan step ' + step.command)
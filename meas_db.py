@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import logging
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+from od_calibration import read_plate_array, well_index
+
+meas_schema_version = 1
+meas_columns = ('lagoon_number', 'filename', 'plate_id', 'timestamp', 'well', 'measurement_delay_time',
+        'reading', 'data_type', 'header_time')
+
+def ensure_meas_table_exists(db_conn):
+    '''
+    Definitions of the fields in this table:
+    lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
+    filename - absolute path to the file in which this data is housed
+    plate_id - ID field given when measurement was requested, should match ID in data file
+    timestamp - time at which the measurement was taken, in seconds since the epoch
+    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
+    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
+                            measurement was taken. For migration, we consider this to be 0
+                            minutes in the absense of pipetting time values
+    reading - the raw measured value from the plate reader
+    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
+    header_time - the time exactly as given in the header of the data file
+
+    Databases made before the table was typed and indexed are upgraded in place (see migrate_meas_db).
+    '''
+    if db_conn.execute('PRAGMA user_version').fetchone()[0] < meas_schema_version and _meas_table_exists(db_conn):
+        migrate_meas_db(db_conn)
+        return
+    _create_meas_table(db_conn, 'measurements')
+    _create_meas_indexes(db_conn)
+    db_conn.execute('PRAGMA user_version = ' + str(meas_schema_version))
+    db_conn.commit()
+
+def _meas_table_exists(db_conn):
+    return db_conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='measurements'").fetchone() is not None
+
+def _create_meas_table(db_conn, table_name):
+    db_conn.execute('''CREATE TABLE if not exists ''' + table_name + '''
+                (lagoon_number INTEGER, filename TEXT, plate_id TEXT, timestamp REAL, well TEXT,
+                measurement_delay_time REAL, reading REAL, data_type TEXT, header_time TEXT)''')
+
+def _create_meas_indexes(db_conn):
+    db_conn.execute('CREATE INDEX if not exists meas_well_type_time ON measurements (well, data_type, timestamp)')
+    db_conn.execute('CREATE INDEX if not exists meas_lagoon_time ON measurements (lagoon_number, timestamp)')
+
+def migrate_meas_db(db_conn):
+    # Upgrade an untyped version-0 measurements table in place, in one transaction. The old timestamp column
+    # held the reader's header time; it moves to header_time and timestamp becomes numeric.
+    version = db_conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= meas_schema_version or not _meas_table_exists(db_conn):
+        return False
+    db_conn.create_function('meas_timestamp', 2, meas_timestamp)
+    with db_conn:
+        db_conn.execute('BEGIN') # the sqlite3 module would otherwise run the DDL statements outside the transaction
+        db_conn.execute('ALTER TABLE measurements RENAME TO measurements_v0')
+        _create_meas_table(db_conn, 'measurements')
+        db_conn.execute('''INSERT INTO measurements
+                    SELECT CAST(lagoon_number AS INTEGER), filename, plate_id, meas_timestamp(filename, timestamp), well,
+                    CAST(measurement_delay_time AS REAL), CAST(reading AS REAL), data_type, timestamp
+                    FROM measurements_v0 ORDER BY rowid''')
+        db_conn.execute('DROP TABLE measurements_v0')
+        _create_meas_indexes(db_conn)
+        db_conn.execute('PRAGMA user_version = ' + str(meas_schema_version))
+    db_conn.execute('ANALYZE')
+    return True
+
+file_time_re = re.compile(r'(\d{6}_\d{4})\.\w+$') # data files are named ..._yymmdd_HHMM.csv
+header_time_formats = ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S')
+
+def meas_timestamp(filename, header_time=None):
+    # Seconds since the epoch for a reading, from the data file name, else the header time, else None
+    match = file_time_re.search(filename or '')
+    if match:
+        return datetime.strptime(match.group(1), '%y%m%d_%H%M').timestamp()
+    if isinstance(header_time, datetime):
+        return header_time.timestamp()
+    for fmt in header_time_formats:
+        try:
+            return datetime.strptime(str(header_time).strip(), fmt).timestamp()
+        except ValueError:
+            pass
+    return None
+
+def plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells, values=None):
+    # values: the plate as an array from od_calibration.read_plate_array(), if the caller already parsed it
+    filename = plate_data.path
+    if values is None:
+        values = read_plate_array(filename)
+    rows, cols = well_index(plate, read_wells)
+    plate_id = plate_data.header.plate_ids[0]
+    header_time = plate_data.header.time
+    timestamp = meas_timestamp(filename, header_time)
+    if timestamp is None:
+        timestamp = time.time()
+    measurement_delay_time = 0.0
+    return [(lagoon_number, filename, plate_id, timestamp, plate.position_id(read_well), measurement_delay_time,
+            reading, data_type, str(header_time))
+            for lagoon_number, read_well, reading in zip(vessel_numbers, read_wells, values[rows, cols].tolist())]
+
+class MeasurementStore:
+    '''
+    Long-lived writer for the measurements table. Holds one connection open in WAL mode for the whole run
+    and inserts each plate read with a single executemany() in one transaction.
+
+    With background=True, rows are handed to a writer thread through a queue, so add_plate_data() returns
+    immediately and the caller never waits on the disk. flush() waits until everything queued is written. If a
+    background write fails, the next add_plate_data(), flush() or close() raises, so a run cannot carry on
+    without storing its measurements. Use as a context manager, or call close(), so queued rows are written
+    before exit.
+    '''
+    def __init__(self, db_path, background=False):
+        self.db_path = db_path
+        self.background = background
+        # connect here, on the caller's thread, so a database that cannot be opened fails at startup
+        self._conn = self._connect(check_same_thread=not background)
+        if background:
+            self._error = None
+            self._queue = Queue()
+            self._thread = Thread(target=self._write_queued, daemon=True) # the only user of the connection
+            self._thread.start()
+
+    def _connect(self, check_same_thread=True):
+        conn = sqlite3.connect(self.db_path, check_same_thread=check_same_thread)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL') # in WAL mode, only checkpoints fsync
+        ensure_meas_table_exists(conn)
+        return conn
+
+    def _write(self, conn, rows):
+        with conn: # one transaction
+            conn.executemany('INSERT INTO measurements (' + ', '.join(meas_columns) + ') VALUES ('
+                    + ', '.join('?'*len(meas_columns)) + ')', rows)
+
+    def _write_queued(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    self._conn.close()
+                    return
+                self._write(self._conn, rows)
+            except Exception as e:
+                logging.exception('MeasurementStore: failed to write %d measurement rows', len(rows))
+                self._error = self._error or e
+            finally:
+                self._queue.task_done()
+
+    def _raise_write_error(self):
+        if self._error is not None:
+            raise IOError('MeasurementStore: writing measurements to ' + self.db_path + ' failed') from self._error
+
+    def add_rows(self, rows):
+        if self.background:
+            self._raise_write_error()
+            self._queue.put(list(rows))
+        else:
+            self._write(self._conn, rows)
+
+    def add_plate_data(self, plate_data, data_type, plate, vessel_numbers, read_wells, values=None):
+        self.add_rows(plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells, values))
+
+    def flush(self):
+        if self.background:
+            self._queue.join()
+            self._raise_write_error()
+
+    def close(self):
+        if self.background:
+            self._queue.put(None)
+            self._thread.join()
+            self._raise_write_error()
+        else:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    # python meas_db.py path/to/run.db [...]: upgrade measurement databases from older versions in place
+    for db_path in sys.argv[1:]:
+        if not os.path.isfile(db_path):
+            print(db_path, 'does not exist')
+            continue
+        db_conn = sqlite3.connect(db_path)
+        print(db_path, 'migrated' if migrate_meas_db(db_conn) else 'already up to date')
+        db_conn.close()
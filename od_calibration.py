@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import numpy as np
+
+# Plate reader exports as arrays, and the curves that turn absorbance into OD.
+#
+# read_plate_array() parses a ClarioStar export (see assets/dummy_platedata.csv) once into a rows x columns array,
+# so a whole plate read is one array lookup instead of a PlateData.value_at() call per well. Calibration applies
+# od = slope*absorbance + offset to a whole plate array at once, where slope and offset are either one value for
+# every well or an array with one per well. The curves live in assets/od_calibration.json, one per reader, so
+# recalibrating means editing that file and nothing else:
+#
+#   {"readers": {"default": {"slope": 5.40541, "offset": -0.193514, "noise": 0.001,
+#                            "wells": {"H12": {"slope": 5.5, "offset": -0.2}}}}}
+#
+# "wells" is optional and overrides the reader-wide curve for the wells it names. "noise" is the standard deviation
+# of one absorbance read of a steady sample (default_noise if not given); the Kalman filter in turb_control uses it,
+# through the slope, to weigh low-OD readings, where it is larger than the relative error.
+
+this_file_dir = os.path.dirname(os.path.abspath(__file__))
+default_path = os.path.join(this_file_dir, 'assets', 'od_calibration.json')
+row_letters = 'ABCDEFGHIJKLMNOP'
+plate_shapes = (8, 12), (16, 24) # smallest that fits the wells in an export is used
+well_line = re.compile(r'^([A-P])(\d+):\s*(\S*)')
+default_noise = .001 # absorbance
+
+def parse_position(pos_id):
+    # 'B3' -> (1, 2)
+    return row_letters.index(pos_id[0]), int(pos_id[1:]) - 1
+
+def well_index(plate, wells):
+    # row and column index arrays for wells (indices into plate), for indexing a plate array
+    if not wells:
+        return np.zeros(0, int), np.zeros(0, int)
+    rows, cols = zip(*(parse_position(plate.position_id(well)) for well in wells))
+    return np.array(rows), np.array(cols)
+
+def read_plate_array(path, shape=None):
+    # First chromatic and cycle only; wells missing from the export, or that did not read ('OVRFLW'), are NaN.
+    readings = {}
+    in_data = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith('End_of_header'):
+                in_data = True
+                continue
+            if not in_data:
+                continue
+            match = well_line.match(line)
+            if match:
+                row, col = row_letters.index(match.group(1)), int(match.group(2)) - 1
+                try:
+                    readings[row, col] = float(match.group(3))
+                except ValueError:
+                    readings[row, col] = np.nan
+            elif readings and line.startswith(('Chromatic:', 'Cycle:')):
+                break
+    if shape is None:
+        num_rows = max((row for row, _ in readings), default=0) + 1
+        num_cols = max((col for _, col in readings), default=0) + 1
+        shape = next((s for s in plate_shapes if num_rows <= s[0] and num_cols <= s[1]), (num_rows, num_cols))
+    values = np.full(shape, np.nan)
+    if readings:
+        rows, cols = zip(*readings)
+        values[rows, cols] = list(readings.values())
+    return values
+
+class Calibration:
+    def __init__(self, slope, offset, wells=None, noise=default_noise):
+        self.slope = slope
+        self.offset = offset
+        self.noise = noise
+        self.wells = wells or {} # position id -> {'slope': ..., 'offset': ...}
+
+    def params(self, shape):
+        # slope and offset arrays of the given plate shape
+        slope = np.full(shape, self.slope, dtype=float)
+        offset = np.full(shape, self.offset, dtype=float)
+        for pos_id, curve in self.wells.items():
+            row, col = parse_position(pos_id)
+            if row < shape[0] and col < shape[1]:
+                slope[row, col] = curve.get('slope', self.slope)
+                offset[row, col] = curve.get('offset', self.offset)
+        return slope, offset
+
+    def to_od(self, absorbance):
+        # absorbance is a whole plate array from read_plate_array()
+        slope, offset = self.params(np.shape(absorbance))
+        return slope*absorbance + offset
+
+    def params_at(self, rows, cols):
+        rows, cols = np.asarray(rows, int), np.asarray(cols, int)
+        if not rows.size:
+            return np.zeros(0), np.zeros(0)
+        slope, offset = self.params((max(rows.max() + 1, 16), max(cols.max() + 1, 24)))
+        return slope[rows, cols], offset[rows, cols]
+
+    def to_od_at(self, absorbance, rows, cols):
+        # absorbance is flat, one reading per (row, col)
+        slope, offset = self.params_at(rows, cols)
+        return slope*np.asarray(absorbance, dtype=float) + offset
+
+    def od_noise_at(self, rows, cols):
+        # the noise of one reading, in OD, for each (row, col)
+        slope, _ = self.params_at(rows, cols)
+        return np.abs(slope)*self.noise
+
+    def to_absorbance_at(self, od, rows, cols):
+        slope, offset = self.params_at(rows, cols)
+        return (np.asarray(od, dtype=float) - offset)/slope
+
+def load_calibration(reader='default', path=default_path):
+    with open(path) as f:
+        readers = json.load(f)['readers']
+    if reader not in readers:
+        raise KeyError('No OD calibration for reader ' + repr(reader) + ' in ' + path)
+    curve = readers[reader]
+    return Calibration(curve['slope'], curve['offset'], curve.get('wells'), curve.get('noise', default_noise))
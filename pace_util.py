@@ -1,7 +1,10 @@
 #!python3
 
-import sys, os, time, logging, importlib
-from threading import Thread
+import sys, os, time, logging, importlib, functools, atexit
+from threading import Thread, Condition, current_thread
+from queue import Queue, Empty
+from concurrent.futures import Future
+import timing
 
 this_file_dir = os.path.dirname(__file__)
 methods_dir = os.path.abspath(os.path.join(this_file_dir, '..', '..', '..'))
@@ -16,25 +19,57 @@ shaker_pkg_path = os.path.join(methods_dir, 'perma_shaker', 'auxshaker')
 
 LAYFILE = os.path.join(this_file_dir, 'assets', 'deck.lay')
 
-for imp_path in (pyham_pkg_path, reader_mod_path, pump_pkg_path, shaker_pkg_path):
-    pkgname = os.path.basename(imp_path)
+# Device drivers are imported on first use, not with this module, so simulations and analysis that only need
+# the helpers below start fast. Each driver package loads (and is looked for in its perma_* folder, if it is not
+# installed) the first time one of its names is taken from this module, e.g. `from pace_util import ClarioStar`
+# or pace_util.Plate96. Helpers that use pyhamilton names themselves are marked @uses_pyhamilton.
+drivers = { # package: (where to look if it is not installed, module, names it provides)
+    'pyhamilton': (pyham_pkg_path, 'pyhamilton', ('pyhamilton', 'HamiltonInterface', 'LayoutManager', 'ResourceType',
+            'Plate24', 'Plate96', 'Tip96', 'INITIALIZE', 'PICKUP', 'EJECT', 'ASPIRATE', 'DISPENSE', 'ISWAP_GET',
+            'ISWAP_PLACE', 'HEPA', 'WASH96_EMPTY', 'PICKUP96', 'EJECT96', 'ASPIRATE96', 'DISPENSE96', 'oemerr',
+            'PositionError')),
+    'platereader': (reader_mod_path, 'platereader.clariostar', ('ClarioStar', 'PlateData')),
+    'auxpump': (pump_pkg_path, 'auxpump.pace', ('OffDeckCulturePumps', 'LBPumps')),
+    'auxshaker': (shaker_pkg_path, 'auxshaker.bigbear', ('Shaker',)),
+}
+driver_for_name = {name: pkgname for pkgname, (_, _, names) in drivers.items() for name in names}
+_loaded_drivers = set()
+
+def load_driver(pkgname):
+    if pkgname in _loaded_drivers:
+        return
+    imp_path, module_name, names = drivers[pkgname]
     try:
         imported_mod = importlib.import_module(pkgname)
     except ModuleNotFoundError:
-        if imp_path not in sys.path:
-            sys.path.append(imp_path)
-            imported_mod = importlib.import_module(pkgname)
+        if imp_path in sys.path:
+            raise
+        sys.path.append(imp_path)
+        imported_mod = importlib.import_module(pkgname)
     print('USING ' + ('SITE-PACKAGES ' if 'site-packages' in os.path.abspath(imported_mod.__file__) else 'LOCAL ') + pkgname)
-
-import pyhamilton
-from pyhamilton import (HamiltonInterface, LayoutManager, ResourceType, Plate24, Plate96, Tip96,
-    INITIALIZE, PICKUP, EJECT, ASPIRATE, DISPENSE, ISWAP_GET, ISWAP_PLACE, HEPA,
-    WASH96_EMPTY, PICKUP96, EJECT96, ASPIRATE96, DISPENSE96,
-    oemerr, PositionError)
-from platereader.clariostar import ClarioStar, PlateData
-from auxpump.pace import OffDeckCulturePumps, LBPumps
-from auxshaker.bigbear import Shaker
-
+    module = importlib.import_module(module_name)
+    for name in names:
+        globals()[name] = imported_mod if name == pkgname else getattr(module, name)
+    _loaded_drivers.add(pkgname)
+
+def __getattr__(name):
+    # only called for names not (yet) in this module
+    if name in driver_for_name:
+        load_driver(driver_for_name[name])
+        return globals()[name]
+    if name == 'fileflag_dir':
+        return _fileflag_dir()
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+def uses_pyhamilton(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'pyhamilton' not in _loaded_drivers:
+            load_driver('pyhamilton')
+        return func(*args, **kwargs)
+    return wrapper
+
+@uses_pyhamilton
 def resource_list_with_prefix(layout_manager, prefix, res_class, num_ress, order_key=None, reverse=False):
     def name_from_line(line):
         field = LayoutManager.layline_objid(line)
@@ -49,6 +84,17 @@ def resource_list_with_prefix(layout_manager, prefix, res_class, num_ress, order
 def labware_pos_str(labware, idx):
     return labware.layout_name() + ', ' + labware.position_id(idx)
 
+class LoggedPositions:
+    # 'labware, A1; labware, B1; (skip)' for a log message, built only when the message is written
+    def __init__(self, pos_tuples):
+        self.pos_tuples = tuple(pos_tuples)
+
+    def __str__(self):
+        return '; '.join(labware_pos_str(*pt) if pt else '(skip)' for pt in self.pos_tuples)
+
+def logged_options(more_options):
+    return ' with extra options ' + str(more_options) if more_options else ''
+
 def compound_pos_str(pos_tuples):
     pos_tuples = pos_tuples[:]; pos_tuples[5] = None # TODO Disable sixth channel out of eight
     present_pos_tups = [pt for pt in pos_tuples if pt is not None]
@@ -57,31 +103,71 @@ def compound_pos_str(pos_tuples):
 def compound_pos_str_96(labware96):
     return ';'.join((labware_pos_str(labware96, idx) for idx in range(96)))
 
-def initialize(ham, async=False):
-    logging.info('initialize: ' + ('a' if async else '') + 'synchronously initialize the robot')
+# Every robot command helper takes block=True. With block=False, the command is sent right away but the
+# helper returns a concurrent.futures.Future instead of waiting, so several commands, plate reads, pump
+# and shaker actions can be in flight at once and waited on together with wait_all(). Futures can also
+# be awaited from asyncio code through asyncio.wrap_future().
+
+def run_nonblocking(func, *args, **kwargs):
+    # Like run_async, but for a single call, and the returned Future holds its result or exception
+    future = Future()
+    def go():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    Thread(target=go, daemon=True).start()
+    return future
+
+def wait_all(*futures, timeout=None):
+    # results of all futures, in order; raises the first exception any of them raised
+    return [future.result(timeout) for future in futures]
+
+def finish_command(ham, block, cmd, span=None, **wait_options):
+    # span is a timing.start() token, finished when the robot responds
+    if block:
+        try:
+            ham.wait_on_response(cmd, raise_first_exception=True, **wait_options)
+        finally:
+            timing.finish(span)
+        return None
+    future = run_nonblocking(ham.wait_on_response, cmd, raise_first_exception=True, **wait_options)
+    if span is not None:
+        future.add_done_callback(lambda _: timing.finish(span))
+    return future
+
+@uses_pyhamilton
+def initialize(ham, block=True):
+    logging.info('initialize: %ssynchronously initialize the robot', '' if block else 'a')
+    span = timing.start('initialize')
     cmd = ham.send_command(INITIALIZE)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
-    return cmd
+    return finish_command(ham, block, cmd, span) or cmd
 
-def hepa_on(ham, speed=15, async=False, **more_options):
-    logging.info('hepa_on: turn on HEPA filter at ' + str(speed) + '% capacity' +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def hepa_on(ham, speed=15, block=True, **more_options):
+    logging.info('hepa_on: turn on HEPA filter at %s%% capacity%s', speed, logged_options(more_options))
+    span = timing.start('hepa_on')
     cmd = ham.send_command(HEPA, fanSpeed=speed, **more_options)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
-    return cmd
+    return finish_command(ham, block, cmd, span) or cmd
 
-def wash_empty_refill(ham, async=False, **more_options):
-    logging.info('wash_empty_refill: empty the washer' +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def wash_empty_refill(ham, block=True, **more_options):
+    logging.info('wash_empty_refill: empty the washer%s', logged_options(more_options))
+    span = timing.start('wash_empty_refill')
     cmd = ham.send_command(WASH96_EMPTY, **more_options)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
-    return cmd
+    return finish_command(ham, block, cmd, span) or cmd
+
+def move_plate(ham, source_plate, target_plate, try_inversions=None, block=True):
+    if not block: # several commands, each depending on the last, so the whole move goes to another thread
+        return run_nonblocking(move_plate, ham, source_plate, target_plate, try_inversions)
+    logging.info('move_plate: Moving plate %s to %s', source_plate.layout_name(), target_plate.layout_name())
+    with timing.span('move_plate'):
+        _move_plate(ham, source_plate, target_plate, try_inversions)
 
-def move_plate(ham, source_plate, target_plate, try_inversions=None):
-    logging.info('move_plate: Moving plate ' + source_plate.layout_name() + ' to ' + target_plate.layout_name())
+@uses_pyhamilton
+def _move_plate(ham, source_plate, target_plate, try_inversions):
     src_pos = labware_pos_str(source_plate, 0)
     trgt_pos = labware_pos_str(target_plate, 0)
     if try_inversions is None:
@@ -117,14 +203,18 @@ def offset_equal_spaced_idxs(start_idx, increment):
         yield idx
         idx += increment
 
-def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id=None, async_task=None, plate_destination=None):
-    logging.info('read_plate: Running plate protocols ' + ', '.join(protocol_names) +
-            ' on plate ' + plate.layout_name() + ('' if plate_id is None else ' with id ' + plate_id))
+def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id=None, async_task=None, plate_destination=None, block=True):
+    if not block:
+        return run_nonblocking(read_plate, ham_int, reader_int, reader_site, plate, protocol_names, plate_id,
+                async_task, plate_destination)
+    logging.info('read_plate: Running plate protocols %s on plate %s%s', ', '.join(protocol_names), plate.layout_name(),
+            '' if plate_id is None else ' with id ' + plate_id)
     reader_int.plate_out(block=True)
     move_plate(ham_int, plate, reader_site)
     if async_task:
         t = run_async(async_task)
-    plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
+    with timing.span('run_protocols', protocols=protocol_names):
+        plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
     reader_int.plate_out(block=True)
     if async_task:
         t.join()
@@ -140,37 +230,39 @@ def channel_var(pos_tuples):
             ch_var[i] = '1'
     return ''.join(ch_var)
 
-def tip_pick_up(ham_int, pos_tuples, **more_options):
-    logging.info('tip_pick_up: Pick up tips at ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def tip_pick_up(ham_int, pos_tuples, block=True, **more_options):
+    logging.info('tip_pick_up: Pick up tips at %s%s', LoggedPositions(pos_tuples), logged_options(more_options))
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only pick up 8 tips at a time')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP,
+    span = timing.start('tip_pick_up', channels=ch_patt)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(PICKUP,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def tip_eject(ham_int, pos_tuples=None, **more_options):
+@uses_pyhamilton
+def tip_eject(ham_int, pos_tuples=None, block=True, **more_options):
     if pos_tuples is None:
-        logging.info('tip_eject: Eject tips to default waste' + ('' if not more_options else ' with extra options ' + str(more_options)))
+        logging.info('tip_eject: Eject tips to default waste%s', logged_options(more_options))
         more_options['useDefaultWaste'] = 1
         dummy = Tip96('')
         pos_tuples = [(dummy, 0)] * 8
     else:
-        logging.info('tip_eject: Eject tips to ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-                ('' if not more_options else ' with extra options ' + str(more_options)))
+        logging.info('tip_eject: Eject tips to %s%s', LoggedPositions(pos_tuples), logged_options(more_options))
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only eject up to 8 tips')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(EJECT,
+    span = timing.start('tip_eject', channels=ch_patt)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(EJECT,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options))
 
 default_liq_class = 'HighVolumeFilter_Water_DispenseJet_Empty_no_transport_vol'
 
@@ -178,108 +270,239 @@ def assert_parallel_nones(list1, list2):
     if not (len(list1) == len(list2) and all([(i1 is None) == (i2 is None) for i1, i2 in zip(list1, list2)])):
         raise ValueError('Lists must have parallel None entries')
 
-def aspirate(ham_int, pos_tuples, vols, **more_options):
+@uses_pyhamilton
+def aspirate(ham_int, pos_tuples, vols, block=True, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('aspirate: Aspirate volumes ' + str(vols) + ' from positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    logging.info('aspirate: Aspirate volumes %s from positions [%s]%s', list(vols), LoggedPositions(pos_tuples),
+            logged_options(more_options))
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE,
-        channelVariable=channel_var(pos_tuples),
+    ch_patt = channel_var(pos_tuples)
+    span = timing.start('aspirate', channels=ch_patt, vols=vols)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(ASPIRATE,
+        channelVariable=ch_patt,
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def dispense(ham_int, pos_tuples, vols, **more_options):
+@uses_pyhamilton
+def dispense(ham_int, pos_tuples, vols, block=True, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('dispense: Dispense volumes ' + str(vols) + ' into positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    logging.info('dispense: Dispense volumes %s into positions [%s]%s', list(vols), LoggedPositions(pos_tuples),
+            logged_options(more_options))
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE,
-        channelVariable=channel_var(pos_tuples),
+    ch_patt = channel_var(pos_tuples)
+    span = timing.start('dispense', channels=ch_patt, vols=vols)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(DISPENSE,
+        channelVariable=ch_patt,
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def tip_pick_up_96(ham_int, tip96, **more_options):
-    logging.info('tip_pick_up_96: Pick up tips at ' + tip96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def tip_pick_up_96(ham_int, tip96, block=True, **more_options):
+    logging.info('tip_pick_up_96: Pick up tips at %s%s', tip96.layout_name(), logged_options(more_options))
     labware_poss = compound_pos_str_96(tip96)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP96,
+    span = timing.start('tip_pick_up_96')
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(PICKUP96,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def tip_eject_96(ham_int, tip96=None, **more_options):
-    logging.info('tip_eject_96: Eject tips to ' + (tip96.layout_name() if tip96 else 'default waste') +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def tip_eject_96(ham_int, tip96=None, block=True, **more_options):
+    logging.info('tip_eject_96: Eject tips to %s%s', tip96.layout_name() if tip96 else 'default waste',
+            logged_options(more_options))
     if tip96 is None:
         labware_poss = ''
         more_options.update({'tipEjectToKnownPosition':2}) # 2 is default waste
     else:   
         labware_poss = compound_pos_str_96(tip96)
-    ham_int.wait_on_response(ham_int.send_command(EJECT96,
+    span = timing.start('tip_eject_96')
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(EJECT96,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def aspirate_96(ham_int, plate96, vol, **more_options):
-    logging.info('aspirate_96: Aspirate volume ' + str(vol) + ' from ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def aspirate_96(ham_int, plate96, vol, block=True, **more_options):
+    logging.info('aspirate_96: Aspirate volume %s from %s%s', vol, plate96.layout_name(), logged_options(more_options))
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE96,
+    span = timing.start('aspirate_96', vol=vol)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(ASPIRATE96,
         labwarePositions=compound_pos_str_96(plate96),
         aspirateVolume=vol,
-        **more_options), raise_first_exception=True)
+        **more_options))
 
-def dispense_96(ham_int, plate96, vol, **more_options):
-    logging.info('dispense_96: Dispense volume ' + str(vol) + ' into ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+@uses_pyhamilton
+def dispense_96(ham_int, plate96, vol, block=True, **more_options):
+    logging.info('dispense_96: Dispense volume %s into %s%s', vol, plate96.layout_name(), logged_options(more_options))
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE96,
+    span = timing.start('dispense_96', vol=vol)
+    return finish_command(ham_int, block, span=span, cmd=ham_int.send_command(DISPENSE96,
         labwarePositions=compound_pos_str_96(plate96),
         dispenseVolume=vol,
-        **more_options), raise_first_exception=True)
+        **more_options))
+
+# Logging goes through a queue to one writer thread, which formats records and writes them to every log file in
+# batches, flushing each file once per batch. Nothing that logs, the robot thread included, ever waits on a log
+# file, however slow the disk (the robot level log is on the shared Monitoring drive). Records are formatted on
+# the writer thread, so log with %-style arguments, which cost nothing when their level is filtered out, and
+# pass values that will not change after the call.
+#
+#   add_log_file(main_logfile)  # starts the writer and routes the root logger through it
+#   add_robot_level_log()
+#   add_stderr_logging()
+
+log_format = '[%(asctime)s] %(name)s %(levelname)s %(message)s'
+
+class BatchFileHandler(logging.FileHandler):
+    # a FileHandler that leaves flushing to the log writer, which flushes once per batch of records
+    def __init__(self, filename):
+        logging.FileHandler.__init__(self, filename, delay=True) # opened on the writer thread, by the first record
+        self.setFormatter(logging.Formatter(log_format))
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.FileHandler.flush(self)
+
+class QueuedLogHandler(logging.Handler):
+    # hands records to a LogWriter as they are, unformatted (logging.handlers.QueueHandler would format them here)
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        self.queue.put_nowait(record)
+
+class LogWriter:
+    def __init__(self, max_batch=1000):
+        self.max_batch = max_batch
+        self.handlers = () # replaced, never changed in place, so the writer thread can read it without a lock
+        self._queue = Queue()
+        self._thread = Thread(target=self._write_queued, daemon=True, name='LogWriter')
+        self._thread.start()
+
+    def add_handler(self, handler):
+        self.handlers += (handler,)
+
+    def _write_queued(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            # a handler that fails (e.g. its network drive is gone) reports it through handleError, as logging
+            # does for a synchronous handler, and the writer carries on with the rest
+            handlers = self.handlers
+            for record in batch:
+                if record is None:
+                    continue
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        try:
+                            handler.handle(record)
+                        except Exception:
+                            handler.handleError(record)
+            for handler in handlers:
+                try:
+                    getattr(handler, 'flush_batch', handler.flush)()
+                except Exception:
+                    handler.handleError(logging.makeLogRecord({'msg': 'LogWriter: flushing ' + repr(handler)}))
+            for _ in batch:
+                self._queue.task_done()
+            if None in batch:
+                for handler in handlers:
+                    handler.close()
+                return
+
+    def on_writer_thread(self):
+        return current_thread() is self._thread
+
+    def flush(self):
+        # wait until everything logged so far is written
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+_log_writers = {}
+
+def log_writer(logger_name=None):
+    # the writer for a logger (the root logger if None), started and attached on first use
+    if logger_name not in _log_writers:
+        writer = LogWriter()
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(QueuedLogHandler(writer._queue))
+        atexit.register(writer.close) # runs before logging's own shutdown, so queued records are written
+        _log_writers[logger_name] = writer
+    return _log_writers[logger_name]
+
+def add_log_file(path, logger_name=None):
+    log_writer(logger_name).add_handler(BatchFileHandler(path))
 
 def add_robot_level_log(logger_name=None):
-    logger = logging.getLogger(logger_name) # root logger if None
-    logger.setLevel(logging.DEBUG)
     with open(os.path.join(user_dir, '.roboid')) as roboid_f:
         robot_id = roboid_f.read()
-    robot_log_dir = os.path.join(global_log_dir, robot_id, robot_id + '.log')
-    hdlr = logging.FileHandler(robot_log_dir)
-    formatter = logging.Formatter('[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    hdlr.setFormatter(formatter)
-    logger.addHandler(hdlr)
+    add_log_file(os.path.join(global_log_dir, robot_id, robot_id + '.log'), logger_name)
 
 class StderrLogger:
-    def __init__(self, level):
+    # tees stderr into a log, a line at a time
+    def __init__(self, level, writer=None):
         self.level = level
+        self.writer = writer
         self.stderr = sys.stderr
+        self._partial = ''
 
     def write(self, message):
         self.stderr.write(message)
-        if message.strip():
-            self.level(message.replace('\n', ''))
+        if self.writer and self.writer.on_writer_thread():
+            return # the log writer reporting its own error; logging it again could loop forever
+        lines = (self._partial + message).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.level(line)
+
+    def flush(self):
+        if self._partial.strip():
+            self.level(self._partial)
+        self._partial = ''
+        self.stderr.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stderr, name) # encoding, fileno, isatty, ...
 
 def add_stderr_logging(logger_name=None):
     logger = logging.getLogger(logger_name) # root logger if None
-    sys.stderr = StderrLogger(logger.error)
-
-fileflag_dir = os.path.abspath('.')
-while fileflag_dir and os.path.basename(fileflag_dir).lower() != 'discrete-turb':
-    fileflag_dir = os.path.dirname(fileflag_dir)
-fileflag_dir = os.path.join(fileflag_dir, 'method_local', 'flags')
+    sys.stderr = StderrLogger(logger.error, _log_writers.get(logger_name))
+
+@functools.lru_cache(maxsize=None)
+def _fileflag_dir():
+    # found on first use rather than at import; cached, so later flag checks do no directory walking
+    flag_dir = os.path.abspath('.')
+    while os.path.basename(flag_dir).lower() != 'discrete-turb':
+        if os.path.dirname(flag_dir) == flag_dir: # reached the root without finding it
+            flag_dir = os.path.abspath(this_file_dir)
+            break
+        flag_dir = os.path.dirname(flag_dir)
+    return os.path.join(flag_dir, 'method_local', 'flags')
 
 def set_fileflag(flag_name):
     assert_fileflag_harmless(flag_name)
+    fileflag_dir = _fileflag_dir()
     flag_loc = os.path.join(fileflag_dir, flag_name)
     if not os.path.isdir(fileflag_dir):
         if os.path.exists(fileflag_dir):
@@ -291,20 +514,20 @@ def set_fileflag(flag_name):
 
 def clear_fileflag(flag_name):
     assert_fileflag_harmless(flag_name)
-    flag_loc = os.path.join(fileflag_dir, flag_name)
+    flag_loc = os.path.join(_fileflag_dir(), flag_name)
     try:
         os.remove(flag_loc)
     except FileNotFoundError:
         pass
 
 def fileflag(flag_name):
-    flag_loc = os.path.join(fileflag_dir, flag_name)
+    flag_loc = os.path.join(_fileflag_dir(), flag_name)
     return os.path.isfile(flag_loc)
 
 def assert_fileflag_harmless(flag_name):
     if not fileflag(flag_name):
         return
-    flag_loc = os.path.join(fileflag_dir, flag_name)
+    flag_loc = os.path.join(_fileflag_dir(), flag_name)
     if os.path.getsize(flag_loc) != 0:
         raise IOError('Fileflag refers to a non-empty file!')
 
@@ -321,6 +544,74 @@ def run_async(funcs):
     func_thread.start()
     return func_thread
 
+class CycleScheduler:
+    '''
+    Runs the steps of one method cycle as a dependency graph instead of strictly in sequence.
+
+    Each step names the devices it uses and the steps it must come after. A step starts as soon as all of
+    its predecessors have finished and none of its devices is in use by a running step, so steps on
+    different devices (e.g. pumps refilling while the channels pipette) overlap. When several steps are
+    ready, the one added first goes first. Each step is called with a dict of the results of the steps
+    that have finished, keyed by step name. With concurrent=False, steps run one at a time in the order
+    they were added, which is handy for debugging. before_step, if given, is called with each step's name
+    just before the step starts, on the thread that runs it; it may block, e.g. to hold steps while paused.
+    '''
+    def __init__(self, concurrent=True, before_step=None):
+        self.concurrent = concurrent
+        self.before_step = before_step
+        self.steps = []
+
+    def add(self, name, func, devices=(), after=()):
+        known = {step[0] for step in self.steps}
+        for dep in after:
+            if dep not in known:
+                raise ValueError('Step ' + name + ' must be added after the step it depends on, ' + dep)
+        self.steps.append((name, func, frozenset(devices), tuple(after)))
+
+    def run(self):
+        results = {}
+        if not self.concurrent:
+            for name, func, _, _ in self.steps:
+                if self.before_step:
+                    self.before_step(name)
+                results[name] = func(results)
+            return results
+        pending = list(self.steps)
+        running = {} # name -> devices
+        errors = []
+        cond = Condition()
+        def launch(name, func):
+            def go():
+                try:
+                    if self.before_step:
+                        self.before_step(name)
+                    result = func(results)
+                except BaseException as e:
+                    errors.append(e)
+                    result = None
+                with cond:
+                    results[name] = result
+                    del running[name]
+                    cond.notify()
+            return go
+        with cond:
+            while pending or running:
+                if not errors:
+                    busy = set().union(*running.values())
+                    for step in list(pending):
+                        name, func, devices, after = step
+                        if all(dep in results for dep in after) and not devices & busy:
+                            pending.remove(step)
+                            running[name] = devices
+                            busy |= devices
+                            run_async(launch(name, func))
+                elif not running:
+                    break
+                cond.wait()
+        if errors:
+            raise errors[0]
+        return results
+
 def yield_in_chunks(sliceable, n):
     sliceable = list(sliceable)
     start_pos = 0
@@ -1,21 +1,35 @@
 #!python3
 
-import sys, os, time, logging, sqlite3
+import sys, os, time, logging
 import types
+import json
 import pdb
-from turb_control import ParamEstTurbCtrlr
+import numpy as np
+import timing
+from turb_control import ParamEstTurbCtrlrBank, KalmanTurbCtrlrBank
+from meas_db import MeasurementStore
+from telemetry import TelemetryWriter
+from tip_inventory import TipInventory
+from lh_planner import Transfer, ChannelRow, plan_transfers, estimate_seconds, run_plan, usable_channels
+from virtual_clock import ScaledClock
+from od_calibration import read_plate_array, well_index, parse_position, load_calibration
+from adaptive_sampling import AdaptiveSampler
+from control_channel import ControlChannel, default_port
 
 this_file_dir = os.path.dirname(os.path.abspath(__file__))
 method_local_dir = os.path.join(this_file_dir, 'method_local')
+twin_mode = '--twin' in sys.argv # run against the in-process device stand-ins in digital_twin.py
+if twin_mode:
+    method_local_dir = os.path.join(method_local_dir, 'twin') # keep twin logs and data apart from real runs
 containing_dirname = os.path.basename(os.path.dirname(this_file_dir))
 
 from pace_util import (
     pyhamilton, LayoutManager, ResourceType, Plate96, Plate24, Tip96,
-    HamiltonInterface as HI, ClarioStar, LBPumps as Pumps, PlateData, Shaker,
+    HamiltonInterface as HI,
     initialize, hepa_on, tip_pick_up, tip_eject, aspirate, dispense, wash_empty_refill,
     tip_pick_up_96, tip_eject_96, aspirate_96, dispense_96,
-    resource_list_with_prefix, read_plate, move_plate, add_robot_level_log, add_stderr_logging,
-    fileflag, clear_fileflag, run_async, yield_in_chunks, log_banner)
+    resource_list_with_prefix, read_plate, move_plate, add_log_file, add_robot_level_log, add_stderr_logging,
+    run_async, run_nonblocking, CycleScheduler, yield_in_chunks, log_banner)
 
 class Timer:
     def __init__(self):
@@ -23,50 +37,25 @@ class Timer:
         self.duration = 0
 
     def start(self, duration):
-        self.start_time = time.time()
+        self.start_time = method_clock.time()
         self.duration = duration
 
     def wait(self):
+        elapsed = method_clock.time() - self.start_time
+        if elapsed > self.duration:
+            logging.warning('CYCLE OVERRUN: took %.0f s of a %.0f s cycle', elapsed, self.duration)
         if simulation_on:
             return
-        while time.time() - self.start_time < self.duration:
-            time.sleep(.1)
-
-def ensure_meas_table_exists(db_conn):
-    '''
-    Definitions of the fields in this table:
-    lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
-    filename - absolute path to the file in which this data is housed
-    plate_id - ID field given when measurement was requested, should match ID in data file
-    timestamp - time at which the measurement was taken
-    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
-    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
-                            measurement was taken. For migration, we consider this to be 0
-                            minutes in the absense of pipetting time values
-    reading - the raw measured value from the plate reader
-    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
-    '''
-    c = db_conn.cursor()
-    c.execute('''CREATE TABLE if not exists measurements
-                (lagoon_number, filename, plate_id, timestamp, well, measurement_delay_time, reading, data_type)''')
-    db_conn.commit()
-
-def db_add_plate_data(plate_data, data_type, plate, vessel_numbers, read_wells):
-    db_conn = sqlite3.connect(os.path.join(method_local_dir, containing_dirname + '.db'))
-    ensure_meas_table_exists(db_conn)
-    c = db_conn.cursor()
-    for lagoon_number, read_well in zip(vessel_numbers, read_wells):
-        filename = plate_data.path
-        plate_id = plate_data.header.plate_ids[0]
-        timestamp = plate_data.header.time
-        well = plate.position_id(read_well)
-        measurement_delay_time = 0.0
-        reading = plate_data.value_at(*plate.well_coords(read_well))
-        data = (lagoon_number, filename, plate_id, timestamp, well, measurement_delay_time, 
-                 reading, data_type)
-        c.execute("INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?)", data)
-    db_conn.commit()
-    db_conn.close()
+        with timing.span('Timer.wait', idle=self.duration - elapsed):
+            while method_clock.time() - self.start_time < self.duration:
+                method_clock.sleep(.1)
+
+def db_add_plate_data(plate_data, data_type, plate, vessel_numbers, read_wells, values=None):
+    sys_state.meas_store.add_plate_data(plate_data, data_type, plate, vessel_numbers, read_wells, values)
+
+def record_telemetry(quantity, values):
+    if sys_state.telemetry:
+        sys_state.telemetry.record(quantity, values)
 
 sys_state = types.SimpleNamespace()
 # define system state
@@ -74,6 +63,10 @@ sys_state.instruments = None
 sys_state.need_to_refill_washer = True
 sys_state.need_to_read_plate = False
 sys_state.mounted_tips = None
+sys_state.meas_store = None
+sys_state.telemetry = None
+sys_state.cycle = 0
+sys_state.due = None # mask of the wells to service this cycle (--adaptive, or wells skipped); None means all of them
 method_start_time = None
 
 cycle_time = 15*60 # 15 minutes
@@ -84,15 +77,42 @@ generation_time = 30 * 60 # seconds
 fixed_turb_height = 8 # mm
 turb_vol = 1430 # uL
 desired_od = .45
+robust_estimator = True # filter readings (rejecting clump spikes) before control; False for raw readings and smoothed k
 fly_disp_height = fixed_turb_height + 9 # mm
 shake_speed = 300
+adaptive_min_period = cycle_time # seconds between services of one well with --adaptive; may be per-well arrays
+adaptive_max_period = 4*cycle_time
+reader_name = 'default' # whose curves in assets/od_calibration.json turn absorbance into OD
+calibration = load_calibration(reader_name)
+
+# Culture plates. deck.lay needs num_turb_plates plates whose names start with 'turbs', and enough 96 well plates
+# whose names start with 'reader_plate' to take a sample from every culture.
+turb_plate_type = Plate24
+num_turb_plates = 1
+num_turbs = None # number of cultures to run, filling plates in order; None for every well of every turb plate
 
 sys_state.disable_pumps = '--no_pumps' in sys.argv
 debug = '--debug' in sys.argv
 simulation_on = debug or '--simulate' in sys.argv
 mid_run = '--continue' in sys.argv
+sequential = '--sequential' in sys.argv # run cycle steps one at a time, in order
+adaptive = '--adaptive' in sys.argv # only sample and dilute the wells that need it each cycle; see adaptive_sampling.py
+
+def flag_value(flag, default, type=float):
+    # value following flag on the command line, e.g. --twin-speed 100
+    if flag in sys.argv:
+        return type(sys.argv[sys.argv.index(flag) + 1])
+    return default
 
-sys_state.waffle_clean_thread = None
+twin_speed = flag_value('--twin-speed', 100.0) # virtual seconds per real second in twin mode
+num_cycles = flag_value('--cycles', None, int) # stop after this many cycles; default is to run forever
+control_port = flag_value('--control-port', default_port, int) # for pause, resume etc.; see control_channel.py
+method_clock = time # anything with time() and sleep(); twin mode speeds it up
+timing_on = '--timing' in sys.argv # time robot commands and cycle phases; histograms go to method_local/timing.json
+timing_file = os.path.join(method_local_dir, 'timing.json')
+checkpoint_file = os.path.join(method_local_dir, 'checkpoint.npz') # written every cycle, restored by --continue
+
+sys_state.waffle_clean = None # Future for the media reservoir bleach, which runs past the end of a cycle
 
 def HamiltonInterface():
     return HI(simulate=simulation_on)
@@ -101,28 +121,41 @@ layfile = os.path.join(this_file_dir, 'assets', 'deck.lay')
 lmgr = LayoutManager(layfile)
 
 # deck locations
-turb_plate = lmgr.assign_unused_resource(ResourceType(Plate24, 'turbs'))
+turb_plates = resource_list_with_prefix(lmgr, 'turbs', turb_plate_type, num_turb_plates)
 media_reservoir = lmgr.assign_unused_resource(ResourceType(Plate96, 'waffle'))
 reader_tray = lmgr.assign_unused_resource(ResourceType(Plate96, 'reader_tray_00001'))
-reader_plate = lmgr.assign_unused_resource(ResourceType(Plate96, 'reader_plate'))
 bleach_site = (#lmgr.assign_unused_resource(ResourceType(Tip96, 'RT300_HW_96WashDualChamber1_bleach')) TODO
             lmgr.assign_unused_resource(ResourceType(Tip96, 'RT300_HW_96WashDualChamber1_water'))) #original rinse_site
-disp_tips = resource_list_with_prefix(lmgr, 'disposable_tips_', Tip96, 1) #TODO: only one box?
+num_disp_tip_racks = 1 # racks named disposable_tips_*; the inventory rotates through all of them
+disp_tips = resource_list_with_prefix(lmgr, 'disposable_tips_', Tip96, num_disp_tip_racks)
 wash_tips = lmgr.assign_unused_resource(ResourceType(Tip96, 'wash_tips'))
 
 #plate_trash = lmgr.assign_unused_resource(ResourceType(Plate96, 'plate_trash'))
 
+def plate_wells(plates):
+    return [(plate, i) for plate in plates for i in range(sum(1 for _ in plate))]
+
+# culture n lives in turb_wells[n] and is sampled into read_wells[n]
+turb_wells = plate_wells(turb_plates)[:num_turbs]
+num_turbs = len(turb_wells)
+reader_plates = resource_list_with_prefix(lmgr, 'reader_plate', Plate96, -(-num_turbs//96))
+read_wells = plate_wells(reader_plates)[:num_turbs]
+sys_state.skipped = np.zeros(num_turbs, dtype=bool) # wells an operator has taken out of service
+control = ControlChannel(num_turbs, control_port)
+
+@timing.timed()
 def system_initialize():
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
     if mid_run:
         print('CONTINUING A PREVIOUSLY INITIALIZED AND PAUSED RUN. WILL SKIP CLEANING. OK? 5 SECONDS TO CANCEL...')
-        time.sleep(5)
+        method_clock.sleep(5)
     local_log_dir = os.path.join(method_local_dir, 'log')
     if not os.path.exists(local_log_dir):
-        os.mkdir(local_log_dir)
+        os.makedirs(local_log_dir)
     main_logfile = os.path.join(local_log_dir, 'main.log')
-    logging.basicConfig(filename=main_logfile, level=logging.DEBUG, format='[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    add_robot_level_log()
+    add_log_file(main_logfile) # written by a background thread, in batches
+    if not twin_mode:
+        add_robot_level_log()
     add_stderr_logging()
     for banner_line in log_banner('Begin execution of ' + __file__):
         logging.info(banner_line)
@@ -133,126 +166,285 @@ def system_initialize():
         shaker.disable()
     ham_int.set_log_dir(os.path.join(local_log_dir, 'hamilton.log'))
     if mid_run:
+        restore_checkpoint()
         prime_and_clean = None
     else:
-        prime_and_clean = run_async(lambda: (#pump_int.prime(),             # important that the shaker is
+        prime_and_clean = run_nonblocking(lambda: (#pump_int.prime(),             # important that the shaker is
             shaker.start(shake_speed), pump_int.bleach_clean(),
             shaker.stop())) # started and stopped at least once
     initialize(ham_int)
     hepa_on(ham_int, simulate=int(simulation_on))
-    method_start_time = time.time()
-    if not sys_state.disable_pumps:
-        wash_empty_refill(ham_int, refillAfterEmpty=2, chamber2WashLiquid=0) # 2=chamber 1 only; 0=Liquid 1 (bleach)
+    method_start_time = method_clock.time()
+    refill_washer()
     if prime_and_clean:
-        prime_and_clean.join()
+        prime_and_clean.result() # re-raises anything that went wrong with the pumps or shaker
     shaker.start(shake_speed) # TODO: For asynchrony
 
-def flow_rate_controller():
+def flow_rate_controllers(num_turbs):
     min_flow_through = (read_sample_vol + 30)/turb_vol
     max_flow_through = max_transfer_vol/turb_vol
-    controller = ParamEstTurbCtrlr(setpoint=desired_od)
-    controller.output_limits = min_flow_through, max_flow_through
-    return controller
+    controller_type = KalmanTurbCtrlrBank if robust_estimator else ParamEstTurbCtrlrBank
+    controllers = controller_type(num_turbs, setpoint=desired_od)
+    controllers.output_limits = min_flow_through, max_flow_through
+    if robust_estimator:
+        rows, cols = np.transpose([parse_position(plate.position_id(well)) for plate, well in read_wells])
+        controllers.meas_od_noise = calibration.od_noise_at(rows, cols)
+    return controllers
 
-def disp_tips_gen():
-    while True:
-        for disp_tip_rack in disp_tips:
-            for i in range(72): # TODO: This is to reset the tip usage so that the same tips have the same roles each iteration so we can get away with reuse(0, 96):
-                yield disp_tip_rack, i
-disp_tips_gen = disp_tips_gen()
+# Disposable tips are put back and reused, each column for one job only: sampling or emptying one fixed batch
+# of wells (the same wells whichever of them are due, each well on its own channel), or media, which is
+# dispensed from above the cultures. So a tip only ever touches one culture, and never carries culture into
+# the media reservoir.
+tip_batch_size = len(usable_channels())
+num_well_batches = -(-num_turbs//tip_batch_size)
+num_tip_groups = 2*num_well_batches + 1
+tip_inventory = TipInventory(disp_tips, os.path.join(method_local_dir, 'tips.json'), resume=mid_run)
+if num_tip_groups > len(tip_inventory.columns):
+    raise ValueError(str(num_turbs) + ' wells need ' + str(num_tip_groups) + ' columns of disposable tips, one per job, '
+            'but ' + str(num_disp_tip_racks) + ' racks have ' + str(len(tip_inventory.columns)) + '; add racks')
+
+def tip_group(step, turb_num):
+    return step + ' ' + str(turb_num//tip_batch_size)
+
+def tip_slot(turb_num):
+    # the channel, within its batch, that always serves this well, so it always gets the same tip
+    return turb_num%tip_batch_size
+
+def well_batches():
+    # the fixed batches of wells that tip groups are kept for, each cut down to the wells due this cycle
+    for batch in yield_in_chunks(range(num_turbs), tip_batch_size):
+        due = [n for n in batch if is_due(n)]
+        if due:
+            yield due
 
-def new_tips():
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
+def new_tips(group=None):
+    ham_int, *_ = sys_state.instruments
     while True:
+        positions = tip_inventory.next_column(group)
         try:
-            positions =[next(disp_tips_gen) for i in range(8)] 
             tip_pick_up(ham_int, positions)
+            tip_inventory.picked_up(group)
             return positions
         except pyhamilton.TipPresentError:
-            tip_eject(ham_int)
+            tip_eject(ham_int) # then try the same column again
         except pyhamilton.NoTipError:
-            pass
+            tip_inventory.mark_empty(group)
 
-batches = (range(8), range(8, 16), range(16, 24))
+def run_logged_plan(name, plan, get_tips=new_tips):
+    logging.info('%s: %d robot steps, about %.0f s', name, len(plan), estimate_seconds(plan))
+    ham_int, *_ = sys_state.instruments
+    run_plan(ham_int, plan, get_tips)
 
+def is_due(turb_num):
+    return sys_state.due is None or sys_state.due[turb_num]
+
+def due_reader_plates():
+    return [plate for plate in reader_plates if any(is_due(n) for n, (p, _) in enumerate(read_wells) if p is plate)]
+
+@timing.timed()
 def sample_turbs():
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
     #shaker.stop() TODO: for asynchrony
-    for batch in batches:
-        tip_poss = new_tips()
-        aspirate(ham_int, [(turb_plate, i) for i in batch], [read_sample_vol]*8)
-        dispense(ham_int, [(reader_plate, i) for i in batch], [read_sample_vol]*8)
-        tip_eject(ham_int, tip_poss)
+    run_logged_plan('SAMPLE', plan_transfers(Transfer(turb_wells[n], read_wells[n], read_sample_vol, tip_group('sample', n), tip_slot(n))
+            for batch in well_batches() for n in batch))
     #shaker.start(shake_speed) TODO: for asynchrony
 
+@timing.timed()
 def read_ods():
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
-    abs_platedata, = read_plate(ham_int, reader_int, reader_tray, reader_plate, ['17_8_12_abs'], 'turb_read_plate')
-    if not abs_platedata:
-        abs_platedata = PlateData(os.path.join('assets', 'dummy_platedata.csv')) # sim dummies
-    list_24 = list(range(24))
-    db_add_plate_data(abs_platedata, 'abs', reader_plate, list_24, list_24)
-    readings = []
-    for i in range(24):
-        data_val = abs_platedata.value_at(*reader_plate.well_coords(i))
-        od = 5.40541*data_val - 0.193514 # empirical best fit line https://docs.google.com/spreadsheets/d/1Fc5jwPgzb_UN-tldBs_IeWo4Yve6KrvkIpQyVNIYQ8U/edit?usp=sharing
-        readings.append(od)
-    logging.info("CONVERTED OD READINGS " + str(readings))
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
+    readings = np.full(num_turbs, np.nan) # stays NaN for wells not sampled this cycle
+    for plate_num, reader_plate in enumerate(due_reader_plates()):
+        abs_platedata, = read_plate(ham_int, reader_int, reader_tray, reader_plate, ['17_8_12_abs'], 'turb_read_plate',
+                async_task=refill_washer if plate_num == 0 else None) # the robot is otherwise idle while the reader reads
+        if not abs_platedata:
+            from pace_util import PlateData
+            abs_platedata = PlateData(os.path.join('assets', 'dummy_platedata.csv')) # sim dummies
+        turb_nums = [n for n, (plate, _) in enumerate(read_wells) if plate is reader_plate and is_due(n)]
+        wells = [read_wells[n][1] for n in turb_nums]
+        absorbance = read_plate_array(abs_platedata.path) # parsed once, for both the database and the controllers
+        db_add_plate_data(abs_platedata, 'abs', reader_plate, turb_nums, wells, absorbance)
+        readings[turb_nums] = calibration.to_od(absorbance)[well_index(reader_plate, wells)]
+    logging.info("CONVERTED OD READINGS %s", readings.tolist())
+    record_telemetry('od_reading', readings)
     return readings
 
-controllers = [flow_rate_controller() for _ in range(24)]
+controllers = flow_rate_controllers(num_turbs)
+sampler = AdaptiveSampler(num_turbs, cycle_time, adaptive_min_period, adaptive_max_period)
 
+@timing.timed()
 def transfer_function(readings):
-    flow_rates = [controller(reading) for controller, reading in zip(controllers, readings)] # step (__call__()) all controllers
-    logging.info("FLOW RATES " + str(flow_rates))
-    logging.info("K ESTIMATES " + str([controller.k_estimate for controller in controllers]))
-    logging.info("OD ESTIMATES " + str([controller.od for controller in controllers]))
-    replace_vols = [rate*turb_vol for rate in flow_rates]
-    logging.info("REPLACEMENT VOLUMES " + str(replace_vols))
+    if sys_state.due is None:
+        flow_rates = controllers(readings) # step (__call__()) all controllers at once
+    elif not adaptive:
+        flow_rates = controllers(readings, mask=sys_state.due) # wells not due get no media this cycle
+    else:
+        now = controllers.clock()
+        predicted = sampler.predict_od(controllers, now)
+        flow_rates = controllers(readings, mask=sys_state.due)
+        sampler.serviced(sys_state.due, readings, predicted, controllers, now)
+        logging.info("SAMPLING PERIODS %s", (sampler.period/cycle_time).tolist())
+        record_telemetry('sampling_period', sampler.period)
+    logging.info("FLOW RATES %s", flow_rates.tolist())
+    logging.info("K ESTIMATES %s", controllers.k_estimate.tolist())
+    logging.info("OD ESTIMATES %s", controllers.od.tolist())
+    if robust_estimator:
+        rejected = np.flatnonzero(controllers.state_history[-1]['rejected'] > 0).tolist()
+        if rejected:
+            logging.warning('OUTLIER READINGS REJECTED FOR WELLS %s', rejected)
+    replace_vols = (flow_rates*turb_vol).tolist()
+    logging.info("REPLACEMENT VOLUMES %s", replace_vols)
+    record_telemetry('flow_rate', flow_rates)
+    record_telemetry('k_estimate', controllers.k_estimate)
+    record_telemetry('od_estimate', controllers.od)
+    record_telemetry('replace_vol', replace_vols)
     return replace_vols
 
-def replace_media(replace_vols):
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
-    if sys_state.waffle_clean_thread:
-        sys_state.waffle_clean_thread.join()
+@timing.timed()
+def refill_media():
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
+    if sys_state.waffle_clean:
+        sys_state.waffle_clean.result()
     pump_int.refill(30)
+
+@timing.timed()
+def replace_media(replace_vols):
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
+    # Media then waste, a batch of wells at a time as the channels hold, so no well waits topped up with media
+    # while the rest are fed. Media is fly-dispensed above the cultures, so its tips never touch them.
     shaker.stop()
-    for batch in batches:
-        tip_poss = new_tips()
-        aspirate(ham_int, [(media_reservoir, i%8) for i in batch], [replace_vols[i] for i in batch])
-        dispense(ham_int, [(turb_plate, i) for i in batch], [replace_vols[i] for i in batch], liquidHeight=fly_disp_height, dispenseMode=9)
-        shaker.start(shake_speed)
-        tip_eject(ham_int, tip_poss) #TODO: only for tip reuse
-        tip_poss = new_tips() #TODO: only for tip reuse
+    def tips_then_stop_shaker(group):
+        tip_poss = new_tips(group)
         shaker.stop()
-        aspirate(ham_int, [(turb_plate, i) for i in batch], [800]*8, liquidHeight=fixed_turb_height)
-        dispense(ham_int, [(bleach_site, i%8 + 88) for i in batch], [800]*8, liquidHeight=15) # +88 for far right side of bleach
-        tip_eject(ham_int, tip_poss)
+        return tip_poss
+    for batch in well_batches():
+        run_logged_plan('MEDIA', plan_transfers((Transfer((media_reservoir, ChannelRow(0)), turb_wells[n], replace_vols[n], 'media')
+                for n in batch), dispense_options={'liquidHeight': fly_disp_height, 'dispenseMode': 9}))
+        shaker.start(shake_speed) # mix in the new media while tips are picked up for the waste
+        run_logged_plan('WASTE', plan_transfers((Transfer(turb_wells[n], (bleach_site, ChannelRow(88)), 800, tip_group('waste', n), tip_slot(n)) # +88 for far right side of bleach
+                for n in batch), aspirate_options={'liquidHeight': fixed_turb_height}, dispense_options={'liquidHeight': 15}),
+                tips_then_stop_shaker)
     shaker.start(shake_speed)
 
-def system_clean():
-    ham_int, reader_int, reader_int, shaker, *_ = sys_state.instruments
-    sys_state.waffle_clean_thread = run_async(pump_int.bleach_clean)
+@timing.timed()
+def bleach_media_reservoir():
+    # runs on through the end of the cycle; refill_media() waits for it next cycle
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
+    sys_state.waffle_clean = run_nonblocking(pump_int.bleach_clean)
+
+@timing.timed()
+def clean_reader_plate():
+    ham_int, reader_int, pump_int, shaker = sys_state.instruments
+    plates_read = due_reader_plates()
+    if not plates_read:
+        return
     tip_pick_up_96(ham_int, wash_tips)
-    for i in range(2):
-        aspirate_96(ham_int, bleach_site, wash_vol)
-        dispense_96(ham_int, reader_plate, wash_vol)
-        aspirate_96(ham_int, reader_plate, wash_vol + read_sample_vol, mixVolume=wash_vol, mixCycles=2)
-        dispense_96(ham_int, bleach_site, wash_vol + read_sample_vol)
+    for reader_plate in plates_read:
+        for i in range(2):
+            aspirate_96(ham_int, bleach_site, wash_vol)
+            dispense_96(ham_int, reader_plate, wash_vol)
+            aspirate_96(ham_int, reader_plate, wash_vol + read_sample_vol, mixVolume=wash_vol, mixCycles=2)
+            dispense_96(ham_int, bleach_site, wash_vol + read_sample_vol)
     tip_eject_96(ham_int, wash_tips)
-    if not sys_state.disable_pumps:
+    sys_state.need_to_refill_washer = True
+
+@timing.timed()
+def refill_washer():
+    ham_int, *_ = sys_state.instruments
+    if sys_state.need_to_refill_washer and not sys_state.disable_pumps:
         wash_empty_refill(ham_int, refillAfterEmpty=2, chamber2WashLiquid=0) # 2=chamber 1 only; 0=Liquid 1 (bleach)
+    sys_state.need_to_refill_washer = False
+
+def cycle_schedule():
+    # Steps that use different devices run at the same time: the pumps refill the media reservoir while the
+    # channels sample and the plate is read, the washer refills during the read, and the reservoir is
+    # bleached while the 96 head cleans the reader plate. The robot does its steps in the same order as a
+    # --sequential run, so the cultures are diluted as soon as the controllers have their readings.
+    schedule = CycleScheduler(concurrent=not sequential, before_step=control.wait_if_paused) # a pause holds the next step
+    schedule.add('refill_media', lambda results: refill_media(), devices={'pumps'})
+    schedule.add('sample', lambda results: sample_turbs(), devices={'ham'})
+    schedule.add('read', lambda results: read_ods(), devices={'ham', 'reader'}, after=['sample'])
+    schedule.add('control', lambda results: transfer_function(results['read']), after=['read'])
+    schedule.add('replace', lambda results: replace_media(results['control']), devices={'ham', 'shaker'},
+            after=['control', 'refill_media'])
+    schedule.add('clean_reader', lambda results: clean_reader_plate(), devices={'ham'}, after=['read', 'replace'])
+    schedule.add('bleach_media', lambda results: bleach_media_reservoir(), devices={'pumps'}, after=['replace'])
+    return schedule
+
+checkpointed_sys_state = 'cycle', 'need_to_refill_washer', 'need_to_read_plate', 'skipped'
 
+def save_checkpoint():
+    # a few kB of arrays; written beside the old checkpoint and swapped in, so a crash leaves one or the other
+    arrays = {'ctrl_' + key: value for key, value in controllers.get_state().items()}
+    arrays.update({'sys_' + key: np.array(getattr(sys_state, key)) for key in checkpointed_sys_state})
+    arrays.update({'sampler_' + key: value for key, value in sampler.get_state().items()})
+    arrays['tip_inventory'] = np.array(json.dumps(tip_inventory.get_state()))
+    arrays['saved_time'] = np.array(method_clock.time())
+    tmp_path = checkpoint_file + '.tmp'
+    with timing.span('save_checkpoint'):
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, checkpoint_file)
 
-def main():
+def restore_checkpoint():
+    if not os.path.exists(checkpoint_file):
+        logging.warning('No checkpoint at %s; controllers start over from their initial estimates', checkpoint_file)
+        return
+    with np.load(checkpoint_file) as checkpoint:
+        controllers.set_state({key[len('ctrl_'):]: checkpoint[key] for key in checkpoint.files if key.startswith('ctrl_')})
+        if adaptive and 'sampler_period' in checkpoint.files:
+            sampler.set_state({key[len('sampler_'):]: checkpoint[key] for key in checkpoint.files if key.startswith('sampler_')})
+        for key in checkpointed_sys_state:
+            if 'sys_' + key in checkpoint.files:
+                value = checkpoint['sys_' + key]
+                setattr(sys_state, key, value.item() if value.ndim == 0 else value)
+        if not os.path.exists(tip_inventory.store_path): # the inventory's own store is saved at every pickup
+            tip_inventory.set_state(json.loads(checkpoint['tip_inventory'].item()), 'Checkpoint ' + checkpoint_file)
+        saved_time = float(checkpoint['saved_time'])
+    logging.info('Restored checkpoint from cycle %d, saved %.0f s ago', sys_state.cycle, method_clock.time() - saved_time)
+
+def apply_control_commands():
+    # operator commands queued by the control channel since the last cycle
+    for command, args in control.pop_commands():
+        if command == 'setpoint':
+            od, wells = args
+            setpoints = np.array(np.broadcast_to(controllers.setpoint, num_turbs), dtype=float)
+            setpoints[wells] = od
+            controllers.setpoint = setpoints
+        elif command == 'skip':
+            sys_state.skipped[args] = True
+        elif command == 'unskip':
+            sys_state.skipped[args] = False
+        logging.info('CONTROL COMMAND %s %s', command.upper(), args)
+
+def control_status():
+    return {'cycle': sys_state.cycle, 'setpoint': np.broadcast_to(controllers.setpoint, num_turbs).tolist(),
+            'skipped': np.flatnonzero(sys_state.skipped).tolist()}
+control.status = control_status
+
+def main(num_cycles=None):
+    # num_cycles counts from the current cycle, which --continue restores from the checkpoint
     timer = Timer()
-    while True:
+    end_cycle = None if num_cycles is None else sys_state.cycle + num_cycles
+    while end_cycle is None or sys_state.cycle < end_cycle:
+        if sys_state.telemetry:
+            sys_state.telemetry.start_cycle(sys_state.cycle)
+        control.wait_if_paused('cycle ' + str(sys_state.cycle))
         timer.start(cycle_time)
-        sample_turbs()
-        readings = read_ods()
-        replace_volumes = transfer_function(readings)
-        replace_media(replace_volumes)
-        system_clean()
+        apply_control_commands()
+        sys_state.due = None
+        if adaptive or sys_state.skipped.any():
+            sys_state.due = (sampler.due(method_clock.time()) if adaptive else np.ones(num_turbs, dtype=bool)) & ~sys_state.skipped
+            logging.info('SERVICING %d OF %d WELLS: %s', sys_state.due.sum(), num_turbs, np.flatnonzero(sys_state.due).tolist())
+            record_telemetry('sampled', sys_state.due)
+        with timing.span('cycle'):
+            cycle_schedule().run()
+        if sys_state.telemetry:
+            sys_state.telemetry.flush()
+        if timing_on:
+            timing.dump(timing_file)
+        sys_state.cycle += 1
+        save_checkpoint()
         timer.wait()
 
 class Nothing:
@@ -263,11 +455,50 @@ class Nothing:
     def __exit__(self, *args):
         pass
 
+def twin_instruments():
+    # stand-ins for every device, sharing one model of the deck's liquid and cultures
+    from digital_twin import DigitalTwin
+    twin = DigitalTwin(method_clock, os.path.join(method_local_dir, 'reader_data'), calibration=calibration)
+    for plate in turb_plates:
+        twin.add_cultures(plate, sum(1 for _ in plate), volume=turb_vol)
+    for plate in reader_plates:
+        twin.track(plate, 96)
+    return twin.instruments(reader_tray)
+
 if __name__ == '__main__':
-    with HamiltonInterface() as ham_int, \
-            ClarioStar() as reader_int, \
-            LBPumps() as pump_int:
-        sys_state.instruments = ham_int, reader_int, pump_int
-        system_initialize()
-        main()
+    if twin_mode:
+        os.makedirs(method_local_dir, exist_ok=True)
+        twin_start = None
+        if mid_run and os.path.exists(checkpoint_file):
+            with np.load(checkpoint_file) as checkpoint: # twin time runs ahead of the wall clock; carry on from it
+                twin_start = max(time.time(), float(checkpoint['saved_time']))
+        method_clock = ScaledClock(twin_speed, twin_start)
+        controllers.clock = method_clock.time
+        instruments = twin_instruments()
+    else:
+        # the reader, pump and shaker drivers are only needed here; --twin runs without them installed
+        from pace_util import ClarioStar, LBPumps as Pumps, Shaker
+        instruments = HamiltonInterface(), ClarioStar(), Pumps(), Shaker()
+    ham_int, reader_int, pump_int, shaker = instruments
+    db_path = os.path.join(method_local_dir, containing_dirname + '.db')
+    with ham_int, reader_int, pump_int, shaker, \
+            MeasurementStore(db_path, background=True) as meas_store, \
+            TelemetryWriter(os.path.join(method_local_dir, containing_dirname + '.tlm'), clock=method_clock.time,
+                    resume=mid_run) as telemetry:
+        sys_state.meas_store = meas_store # writes plate data off the robot thread
+        sys_state.telemetry = telemetry
+        sys_state.instruments = instruments
+        timing.enable(timing_on, span_clock=method_clock.time if twin_mode else None)
+        try:
+            system_initialize()
+            try:
+                control.start()
+            except OSError as e: # e.g. the port is taken by another run; the method works without it
+                logging.warning('No control channel on port %d: %s', control_port, e)
+            main(num_cycles)
+        finally:
+            control.close()
+            if timing_on:
+                timing.dump(timing_file)
+                logging.info('TIMING SUMMARY\n%s', timing.summary())
     
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+import time
+import numpy as np
+
+# Per-cycle, per-well telemetry as an append-only binary file of fixed-size records. The file is a 16-byte
+# header followed by packed records of record_dtype, so analysis code can np.memmap it directly
+# (see load_telemetry) instead of parsing numbers back out of the text log.
+#
+# Every run of the method appends to the same file and numbers its cycles from 0, so each record also carries
+# the number of the run that wrote it. A run started with resume=True (--continue) carries on the last run.
+
+header = b'TURBTELEMETRY\x00\x00\x02' # last byte is the format version
+record_dtype = np.dtype([('timestamp', '<f8'), ('run', '<u2'), ('cycle', '<u4'), ('well', '<u2'), ('quantity', 'u1'),
+        ('value', '<f8')])
+quantities = ('od_reading', 'flow_rate', 'k_estimate', 'od_estimate', 'replace_vol',
+        'sampled', 'sampling_period') # stored as index into this
+quantity_codes = {name: code for code, name in enumerate(quantities)}
+
+class TelemetryWriter:
+    def __init__(self, path, clock=time.time, resume=False):
+        self.path = path
+        self.clock = clock
+        self.cycle = 0
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if new_file:
+            self.run = 0
+        else:
+            records = load_telemetry(path) # checks the header before anything is appended
+            last_run = int(records['run'][-1]) if len(records) else -1
+            self.run = max(last_run, 0) if resume else last_run + 1
+            del records
+        self._file = open(path, 'ab')
+        if new_file:
+            self._file.write(header)
+        else:
+            self._trim_partial_record()
+
+    def _trim_partial_record(self):
+        # a crash mid-write can leave a partial record at the end; drop it so later records stay aligned
+        size = os.path.getsize(self.path)
+        excess = (size - len(header)) % record_dtype.itemsize
+        if excess:
+            self._file.truncate(size - excess)
+
+    def start_cycle(self, cycle):
+        self.cycle = cycle
+
+    def record(self, quantity, values, wells=None, timestamp=None):
+        # one record per value; wells defaults to 0..len(values)-1
+        values = np.asarray(values, dtype=float).ravel()
+        records = np.empty(len(values), record_dtype)
+        records['timestamp'] = self.clock() if timestamp is None else timestamp
+        records['run'] = self.run
+        records['cycle'] = self.cycle
+        records['well'] = np.arange(len(values)) if wells is None else wells
+        records['quantity'] = quantity_codes[quantity]
+        records['value'] = values
+        self._file.write(records.tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def load_telemetry(path):
+    # Read-only memory map of every complete record in the file
+    with open(path, 'rb') as f:
+        if f.read(len(header)) != header:
+            raise IOError(path + ' is not a telemetry file of a supported version')
+    num_records = (os.path.getsize(path) - len(header))//record_dtype.itemsize
+    if not num_records:
+        return np.empty(0, record_dtype)
+    return np.memmap(path, dtype=record_dtype, mode='r', offset=len(header), shape=(num_records,))
+
+def quantity_table(records, quantity):
+    # -> (cycle timestamps, cycles x wells array of values, NaN where a well has no record that cycle), with
+    # the cycles of every run in the file, in order
+    records = records[records['quantity'] == quantity_codes[quantity]]
+    run_cycles = records['run'].astype(np.uint64) << np.uint64(32) | records['cycle']
+    cycles, cycle_idx = np.unique(run_cycles, return_inverse=True)
+    num_wells = int(records['well'].max()) + 1 if len(records) else 0
+    table = np.full((len(cycles), num_wells), np.nan)
+    table[cycle_idx, records['well']] = records['value']
+    times = np.full(len(cycles), np.nan)
+    times[cycle_idx] = records['timestamp']
+    return times, table
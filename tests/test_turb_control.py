@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+method_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if method_path not in sys.path:
+    sys.path.append(method_path)
+from turb_control import KalmanTurbCtrlrBank
+from od_calibration import load_calibration
+
+# Run with: python -m pytest tests
+
+cycle_time = 15*60
+slope = 5.40541 # assets/od_calibration.json, default reader
+
+def low_od_bank(n):
+    # cultures starting well below setpoint, as after inoculation
+    bank = KalmanTurbCtrlrBank(n, setpoint=.5)
+    bank.output_limits = .1, .9
+    bank.meas_od_noise = slope*.001
+    return bank
+
+def grow(od, flow_rate, k=.7):
+    return od*np.exp(k*cycle_time/3600)/(1 + flow_rate)
+
+def test_no_rejections_at_low_od_without_spikes():
+    rng = np.random.default_rng(0)
+    n = 384
+    bank = low_od_bank(n)
+    od, flow_rates = np.full(n, .05), np.zeros(n)
+    rejected = []
+    for _ in range(24):
+        od = grow(od, flow_rates)
+        flow_rates = bank.step(cycle_time, od + slope*rng.normal(0, .001, n))
+        rejected.append(bank.state_history[-1]['rejected'])
+    assert np.mean(rejected) < .001
+
+def test_spikes_still_rejected():
+    rng = np.random.default_rng(0)
+    n = 96
+    bank = low_od_bank(n)
+    od, flow_rates = np.full(n, .05), np.zeros(n)
+    for _ in range(12):
+        od = grow(od, flow_rates)
+        flow_rates = bank.step(cycle_time, od + slope*rng.normal(0, .001, n))
+    od = grow(od, flow_rates)
+    spiked = np.arange(n)%8 == 0
+    bank.step(cycle_time, od + slope*rng.normal(0, .001, n) + np.where(spiked, .2, 0))
+    np.testing.assert_array_equal(bank.state_history[-1]['rejected'] > 0, spiked)
+
+def test_noise_from_calibration():
+    calibration = load_calibration()
+    np.testing.assert_allclose(calibration.od_noise_at([0, 7], [0, 11]), abs(calibration.slope)*calibration.noise)
+
+def test_masked_step_records_nothing_for_unmasked_wells():
+    n = 8
+    bank = low_od_bank(n)
+    bank.step(cycle_time, np.full(n, .06))
+    mask = np.arange(n) < 4
+    readings = np.where(mask, .07, 5.0) # wells outside the mask would be rejected if they were looked at
+    bank.step(cycle_time, readings, mask=mask)
+    row = bank.state_history[-1]
+    np.testing.assert_array_equal(row['od_meas'], np.where(mask, .07, np.nan))
+    assert np.isnan(row['log_od_var'][~mask]).all() and np.isnan(row['k_var'][~mask]).all()
+    assert np.isfinite(row['log_od_var'][mask]).all() and np.isfinite(row['k_var'][mask]).all()
+    np.testing.assert_array_equal(row['rejected'], 0)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import functools
+import threading
+from collections import deque
+
+# Timing spans for robot commands and method phases, aggregated into per-name latency histograms.
+# Off by default; while off, start() returns None, span() returns a shared do-nothing context manager and
+# @timed functions call straight through, so instrumented code costs one global lookup per call.
+#
+#   timing.enable()
+#   with timing.span('sample_turbs'): ...
+#   @timing.timed() def read_ods(): ...
+#   token = timing.start('aspirate', channels='11110111'); ...; timing.finish(token)
+#   print(timing.summary()); timing.dump('timing.json')
+
+enabled = False
+clock = time.perf_counter
+bin_edges = [2.0**k for k in range(-10, 18)] # seconds, ~1 ms to ~1.5 days; one more bin above the last edge
+max_recent_spans = 10000
+
+_lock = threading.Lock()
+_stats = {}
+_recent = deque(maxlen=max_recent_spans)
+
+def enable(on=True, span_clock=None):
+    global enabled, clock
+    enabled = on
+    if span_clock is not None:
+        clock = span_clock
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _recent.clear()
+
+def start(name, **attrs):
+    if not enabled:
+        return None
+    return name, clock(), attrs
+
+def finish(token):
+    if token is None:
+        return
+    name, start_time, attrs = token
+    end_time = clock()
+    duration = end_time - start_time
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'counts': [0]*(len(bin_edges) + 1)}
+        stats['count'] += 1
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+        stats['counts'][_bin(duration)] += 1
+        _recent.append({'name': name, 'start': start_time, 'duration': duration, **attrs})
+
+def _bin(duration):
+    for i, edge in enumerate(bin_edges):
+        if duration < edge:
+            return i
+    return len(bin_edges)
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.token = name, clock(), attrs
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        finish(self.token)
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+_no_span = _NoSpan()
+
+def span(name, **attrs):
+    if not enabled:
+        return _no_span
+    return _Span(name, attrs)
+
+def timed(name=None):
+    # decorator; spans are named after the function unless a name is given
+    def decorate(func):
+        span_name = name or func.__name__
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            token = start(span_name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish(token)
+        return timed_func
+    return decorate
+
+def percentile(stats, q):
+    # upper bin edge below which a fraction q of the spans fall
+    target = q*stats['count']
+    seen = 0
+    for edge, count in zip(bin_edges, stats['counts']):
+        seen += count
+        if seen >= target:
+            return min(edge, stats['max'])
+    return stats['max']
+
+def histograms():
+    with _lock:
+        stats = {name: dict(s, counts=list(s['counts'])) for name, s in _stats.items()}
+    for s in stats.values():
+        s['mean'] = s['total']/s['count']
+        s['p50'] = percentile(s, .5)
+        s['p95'] = percentile(s, .95)
+    return stats
+
+def summary():
+    lines = ['{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('span', 'count', 'mean s', 'p50 s', 'p95 s', 'max s', 'total s')]
+    for name, s in sorted(histograms().items(), key=lambda item: -item[1]['total']):
+        lines.append('{:<24}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>12.1f}'.format(
+                name, s['count'], s['mean'], s['p50'], s['p95'], s['max'], s['total']))
+    return '\n'.join(lines)
+
+def dump(path):
+    with _lock:
+        recent = list(_recent)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'bin_edges': bin_edges, 'spans': histograms(), 'recent': recent}, f, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,86 @@
+import os
+import json
+from collections import deque
+
+# Which columns of the disposable tip racks still hold tips, and which job each is kept for, in a small JSON file
+# so that a --continue run carries on where the last one stopped. The method puts tips back after use, which is
+# only safe if a tip always does the same job, so each tip group (e.g. sampling one fixed batch of wells) gets a
+# column of its own the first time it picks up, and takes its tips from that column every time after. Tips used
+# without a group go to waste, so their column is not handed out again. A column whose pickup finds no tips is
+# given up for good; if it belonged to a group, the group gets a fresh column next time.
+
+class TipInventory:
+    def __init__(self, racks, store_path=None, positions_per_rack=96, column_height=8, resume=False):
+        self.racks = list(racks)
+        self.store_path = store_path
+        self.column_height = column_height
+        self.columns = [(rack_idx, start) for rack_idx in range(len(self.racks))
+                for start in range(0, positions_per_rack, column_height)]
+        self.fresh = deque(range(len(self.columns))) # never used; front is next up
+        self.groups = {} # tip group -> its column
+        self.pickups = [0]*len(self.columns)
+        if resume and store_path and os.path.exists(store_path):
+            self.load()
+
+    def rack_names(self):
+        return [rack.layout_name() for rack in self.racks]
+
+    def _column(self, group):
+        if group in self.groups:
+            return self.groups[group]
+        if not self.fresh:
+            raise RuntimeError('Out of disposable tips in ' + ', '.join(self.rack_names()))
+        return self.fresh[0]
+
+    def next_column(self, group=None):
+        rack_idx, start = self.columns[self._column(group)]
+        rack = self.racks[rack_idx]
+        return [(rack, i) for i in range(start, start + self.column_height)]
+
+    def picked_up(self, group=None):
+        # the column from next_column(group) worked
+        column = self._column(group)
+        if group not in self.groups:
+            self.fresh.popleft()
+            if group is not None:
+                self.groups[group] = column
+        self.pickups[column] += 1
+        self.save()
+
+    def mark_empty(self, group=None):
+        # the column from next_column(group) had no tips
+        if group in self.groups:
+            del self.groups[group]
+        else:
+            self.fresh.popleft()
+        self.save()
+
+    def num_columns_left(self):
+        # columns not yet given to a group or used up
+        return len(self.fresh)
+
+    def get_state(self):
+        return {'racks': self.rack_names(), 'columns': self.columns, 'fresh': list(self.fresh),
+                'groups': self.groups, 'pickups': list(self.pickups)}
+
+    def set_state(self, state, source='Tip inventory'):
+        if state['racks'] != self.rack_names() or [tuple(c) for c in state['columns']] != self.columns:
+            raise ValueError(source + ' does not match the deck layout; delete it to start over with full racks')
+        if 'groups' not in state:
+            raise ValueError(source + ' does not record which job each column did; delete it to start over with '
+                    'full racks')
+        self.fresh = deque(state['fresh'])
+        self.groups = dict(state['groups'])
+        self.pickups = list(state['pickups'])
+
+    def save(self):
+        if not self.store_path:
+            return
+        tmp_path = self.store_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.get_state(), f)
+        os.replace(tmp_path, self.store_path) # never leaves a half-written store behind
+
+    def load(self):
+        with open(self.store_path) as f:
+            self.set_state(json.load(f), 'Tip inventory ' + self.store_path)
@@ -1,19 +1,101 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-import random
 import time
 
+class StateHistory:
+    # Columnar record of controller states: one preallocated array per field, NaN where a state lacks the field.
+    # Rows live in a buffer with room to spare, so the kept rows are always one contiguous slice and column()
+    # can hand out views without copying. With a capacity, only the newest `capacity` rows are kept; older rows
+    # are appended to spill_path (if given) in batches, as raw records of record_dtype (see spilled()). Records
+    # already in spill_path, from an earlier run, are left alone and are not part of this history.
+    def __init__(self, fields, row_shape=(), capacity=None, spill_path=None, dtype=float):
+        self.fields = tuple(fields)
+        self.row_shape = tuple(row_shape)
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.record_dtype = np.dtype([(field, dtype, self.row_shape) for field in self.fields])
+        self.num_spilled = 0
+        self._spill_offset = os.path.getsize(spill_path) if spill_path and os.path.exists(spill_path) else 0
+        self._start = self._end = 0
+        self._cols = self._alloc(2*capacity if capacity else 64)
+
+    def _alloc(self, num_rows):
+        return {field: np.full((num_rows,) + self.row_shape, np.nan, self.record_dtype[field].base)
+                for field in self.fields}
+
+    def _first(self):
+        if self.capacity is None:
+            return self._start
+        return max(self._start, self._end - self.capacity)
+
+    def __len__(self):
+        return self._end - self._first()
+
+    def append(self, state):
+        if self._end == len(self._cols[self.fields[0]]):
+            self._make_room()
+        for field in self.fields:
+            self._cols[field][self._end] = state.get(field, np.nan)
+        self._end += 1
+
+    def _make_room(self):
+        # Copies into fresh arrays rather than shifting in place, so views handed out earlier stay valid
+        first = self._first()
+        if first > self._start:
+            self._spill(self._start, first)
+        num_kept = self._end - first
+        new_cols = self._alloc(2*self.capacity if self.capacity else 2*len(self._cols[self.fields[0]]))
+        for field in self.fields:
+            new_cols[field][:num_kept] = self._cols[field][first:self._end]
+        self._cols = new_cols
+        self._start, self._end = 0, num_kept
+
+    def _spill(self, start, end):
+        if self.spill_path is not None:
+            records = np.empty(end - start, self.record_dtype)
+            for field in self.fields:
+                records[field] = self._cols[field][start:end]
+            with open(self.spill_path, 'ab') as f:
+                records.tofile(f)
+        self.num_spilled += end - start
+
+    def column(self, field, include_spilled=False):
+        if not include_spilled:
+            return self._cols[field][self._first():self._end] # a view, no copy
+        # rows already evicted from the window but not yet spilled are still in memory
+        return np.concatenate((self.spilled()[field], self._cols[field][self._start:self._end]))
+
+    def spilled(self):
+        if self.spill_path is None or not self.num_spilled:
+            return np.empty(0, self.record_dtype)
+        return np.memmap(self.spill_path, dtype=self.record_dtype, mode='r', offset=self._spill_offset,
+                shape=(self.num_spilled,))
+
+    def __getitem__(self, idx):
+        row = range(self._first(), self._end)[idx]
+        return {field: self._cols[field][row] for field in self.fields}
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 class TurbController: # Abstract class for real-time turbidostat feedback control
-    def __init__(self, setpoint=0.0, init_od=1e-6):
+    history_fields = ('update_time', 'od', 'delta_time', 'output')
+
+    def __init__(self, setpoint=0.0, init_od=1e-6, history_capacity=None, history_spill_path=None, clock=None):
         self.output_limits = 0, float('inf')
         self.setpoint = setpoint
         self.od = init_od
-        self.state = {'update_time': time.time(), 'od':init_od}
-        self.state_history = [self.state]
+        self.clock = time.time if clock is None else clock # any callable returning seconds, e.g. a VirtualClock
+        self.state = {'update_time': self.clock(), 'od':init_od}
+        self.prior_state = None
+        # initial state is not recorded, only states produced by step()
+        self.state_history = StateHistory(self.history_fields, capacity=history_capacity, spill_path=history_spill_path)
 
     def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None):
+        self.prior_state = self.state
         if delta_time is None: # use real time
-            self.state = {'update_time': time.time()}
+            self.state = {'update_time': self.clock()}
         else: 
             self.state = {'update_time': self._last_time() + delta_time}
         delta_time = self.state['update_time'] - self._last_time()
@@ -32,27 +114,35 @@ class TurbController: # Abstract class for real-time turbidostat feedback contro
         pass
     
     def _last_time(self):
-        return self.state_history[-1]['update_time']
+        return self.prior_state['update_time']
 
     def history(self):
-        return self.state_history[1:] if self.state_history else [] # omit initial state
+        return self.state_history
 
     def scrape_history(self, key, fill_value = None):
-        return [state.get(key, fill_value) for state in self.history()]
+        # zero-copy view unless missing values need filling
+        column = self.state_history.column(key)
+        if fill_value is None:
+            return column
+        return np.where(np.isnan(column), fill_value, column)
 
     def __call__(self, *args, **kwargs):
         return self.step(None, *args, **kwargs) # default to real time
 
 
 class ParamEstTurbCtrlr(TurbController):
-    def __init__(self, setpoint=0.0, init_od=1e-6, init_k=None):
-        super(ParamEstTurbCtrlr, self).__init__(setpoint, init_od)
+    history_fields = TurbController.history_fields + ('k_estimate',)
+
+    def __init__(self, setpoint=0.0, init_od=1e-6, init_k=None, **controller_options):
+        super(ParamEstTurbCtrlr, self).__init__(setpoint, init_od, **controller_options)
         self.default_k = 1.8
         if init_k is None:
             init_k = self.default_k
         self.k_estimate = init_k
         self.state.update({'k_estimate': init_k})
         self.k_limits = .05, 5
+        self.k_gain = .15 # weight of each new k inference in the smoothed k estimate
+        self.approach_gain = .7 # fraction of the distance to setpoint to close per step
 
     def predict_od(self, od_now, transfer_vol_frac, dt, k):
         # delta time (dt) is in seconds, k is in hr^-1
@@ -63,7 +153,7 @@ class ParamEstTurbCtrlr(TurbController):
         return max(min_k, min(max_k, np.log((transfer_vol_frac + 1)*od_now/od_then)/dt*3600))
 
     def _step(self, delta_time, od_meas, last_transfer_frac=None):
-        last_state = self.state_history[-1]
+        last_state = self.prior_state
         prior_od = last_state.get('od', self.od)
         prior_out = last_state.get('output', 0) if last_transfer_frac is None else last_transfer_frac
         prior_k = last_state.get('k_estimate', self.default_k)
@@ -71,11 +161,11 @@ class ParamEstTurbCtrlr(TurbController):
             prediction = self.predict_od(prior_od, prior_out, delta_time, prior_k)
             self.od = od_meas # max(prediction - .05, min(prediction + .05, od_meas)) # clamp based on prediction to rule out crazy readings
         #error = self.predict_od(prior_od, prior_out, delta_time, prior_k) - od_meas
-        s = .15
+        s = self.k_gain
         self.k_estimate = prior_k*(1-s) + self.infer_k(prior_od, prior_out, self.od, delta_time)*s
         # try to close a fraction of the distance to the correct volume per iteration
         # use model to solve for perfect transfer volume, which may not be achievable
-        s = .7
+        s = self.approach_gain
         transfer_vol_frac = (self.od*np.exp(delta_time/3600*self.k_estimate)
                     /((self.setpoint*s + prior_od*(1-s))) - 1)
         # limit output
@@ -87,6 +177,254 @@ class ParamEstTurbCtrlr(TurbController):
     def set_od(self, od):
         self.od = od
 
+
+class ParamEstTurbCtrlrBank:
+    # Same control law as ParamEstTurbCtrlr, but for n wells at once. Every per-well quantity
+    # (od, k_estimate, setpoint, output limits) is a length-n array and one step() updates all wells.
+    # step(..., mask=m) updates only the wells where m is True: the others keep their state and last update
+    # time, as if they had not been measured, and get an output of 0. Once a mask is used, update_time and
+    # delta_time are per-well arrays.
+    history_fields = ParamEstTurbCtrlr.history_fields
+
+    def __init__(self, n, setpoint=0.0, init_od=1e-6, init_k=None, history_capacity=None, history_spill_path=None, clock=None):
+        self.n = n
+        self.clock = time.time if clock is None else clock
+        self.default_k = 1.8
+        if init_k is None:
+            init_k = self.default_k
+        self.setpoint = setpoint # scalar or length-n array, broadcast in _step
+        self.output_limits = 0, float('inf') # each limit may also be a length-n array
+        self.k_limits = .05, 5
+        self.k_gain = .15
+        self.approach_gain = .7
+        self.od = np.full(n, init_od, dtype=float)
+        self.k_estimate = np.full(n, init_k, dtype=float)
+        self.state = {'update_time': self.clock(), 'od': self.od.copy(), 'k_estimate': self.k_estimate.copy()}
+        self.state_history = StateHistory(self.history_fields, row_shape=(n,),
+                capacity=history_capacity, spill_path=history_spill_path)
+
+    def __len__(self):
+        return self.n
+
+    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None, mask=None):
+        last_state = self.state
+        if delta_time is None: # use real time
+            update_time = self.clock()
+        else:
+            update_time = last_state['update_time'] + delta_time
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            update_time = np.where(mask, update_time, last_state['update_time'])
+        delta_time = update_time - last_state['update_time']
+        transfer_vol_frac = self._step(last_state, delta_time, od_meas, last_transfer_vol_frac)
+        if mask is None:
+            last_output = transfer_vol_frac
+        else:
+            self.od = np.where(mask, self.od, last_state['od'])
+            self.k_estimate = np.where(mask, self.k_estimate, last_state['k_estimate'])
+            # unmeasured wells are not diluted; their last real output is still what the next step infers k from
+            last_output = np.where(mask, transfer_vol_frac, last_state.get('output', 0.0))
+            transfer_vol_frac = np.where(mask, transfer_vol_frac, 0.0)
+        self.state = {'update_time': update_time, 'od': self.od.copy(), 'delta_time': delta_time,
+                'output': last_output, 'k_estimate': self.k_estimate.copy()}
+        self._record(dict(self.state, output=transfer_vol_frac))
+        return transfer_vol_frac
+
+    def _record(self, row):
+        self.state_history.append(row)
+
+    def predict_od(self, od_now, transfer_vol_frac, dt, k):
+        return od_now*np.exp(dt/3600*k)/(1+transfer_vol_frac)
+
+    def infer_k(self, od_then, transfer_vol_frac, od_now, dt):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = np.log((transfer_vol_frac + 1)*od_now/od_then)/dt*3600
+        min_k, max_k = self.k_limits
+        return self._limit(k, min_k, max_k, nan_to=max_k)
+
+    def _step(self, last_state, delta_time, od_meas, last_transfer_frac=None):
+        prior_od = last_state['od']
+        prior_out = last_state.get('output', np.zeros(self.n)) if last_transfer_frac is None else np.asarray(last_transfer_frac, dtype=float)
+        prior_k = last_state['k_estimate']
+        if od_meas is not None:
+            self.od = np.array(od_meas, dtype=float)
+        s = self.k_gain
+        self.k_estimate = prior_k*(1-s) + self.infer_k(prior_od, prior_out, self.od, delta_time)*s
+        s = self.approach_gain
+        transfer_vol_frac = (self.od*np.exp(delta_time/3600*self.k_estimate)
+                    /((self.setpoint*s + prior_od*(1-s))) - 1)
+        min_out, max_out = self.output_limits
+        return self._limit(transfer_vol_frac, min_out, max_out, nan_to=min_out)
+
+    @staticmethod
+    def _limit(x, lo, hi, nan_to):
+        # elementwise clamp; nan_to reproduces what the scalar class's nested min()/max() return for NaN
+        x = np.where(np.isnan(x), nan_to, x)
+        return np.minimum(hi, np.maximum(lo, x))
+
+    def history(self):
+        return self.state_history
+
+    def scrape_history(self, key, fill_value=None):
+        # rows are cycles, columns are wells
+        column = self.state_history.column(key)
+        if fill_value is None:
+            return column
+        return np.where(np.isnan(column), fill_value, column)
+
+    def set_od(self, od):
+        self.od = np.array(np.broadcast_to(od, self.n), dtype=float)
+
+    def get_state(self):
+        # everything the next step() depends on, as arrays, for checkpointing; history is not included
+        state = {'update_time': np.array(self.state['update_time'], dtype=float),
+                'od': self.od.copy(), 'k_estimate': self.k_estimate.copy(),
+                'setpoint': np.array(np.broadcast_to(self.setpoint, self.n), dtype=float)}
+        if 'output' in self.state:
+            state['output'] = np.array(self.state['output'], dtype=float)
+        return state
+
+    def set_state(self, state):
+        if len(state['od']) != self.n:
+            raise ValueError('Controller state is for ' + str(len(state['od'])) + ' wells, not ' + str(self.n))
+        self.od = np.array(state['od'], dtype=float)
+        self.k_estimate = np.array(state['k_estimate'], dtype=float)
+        update_time = np.array(state['update_time'], dtype=float) # per well, if a mask has been used
+        self.state = {'update_time': update_time if update_time.ndim else float(update_time),
+                'od': self.od.copy(), 'k_estimate': self.k_estimate.copy()}
+        if 'output' in state:
+            self.state['output'] = np.array(state['output'], dtype=float)
+        if 'setpoint' in state: # may have been changed during the run, e.g. through the control channel
+            self.setpoint = np.array(state['setpoint'], dtype=float)
+
+    def __call__(self, *args, **kwargs):
+        return self.step(None, *args, **kwargs) # default to real time
+
+
+class KalmanTurbCtrlrBank(ParamEstTurbCtrlrBank):
+    # Same control law as ParamEstTurbCtrlrBank, but od and k_estimate come from a Kalman filter over
+    # (log OD, k) per well instead of raw readings and exponential smoothing of inferred k. In log space the
+    # growth model is linear: log od grows by k*dt/3600 and drops by log(1 + output) at each dilution, and k
+    # drifts as a random walk. All wells update together; the 2x2 covariance of each well is kept as three
+    # arrays (see covariance()).
+    # A reading's variance in log space is meas_var (relative error) plus (meas_od_noise/od)**2, the reader's
+    # absolute noise, which dominates at low OD; meas_od_noise is in OD units, one value or one per well (see
+    # Calibration.od_noise_at()). Readings more than outlier_gate standard deviations from the prediction (clumps
+    # occluding the sensor) are rejected rather than folded in. After max_rejects rejections in a row the well is assumed to have really
+    # changed (or the filter to have lost track), and it starts over from the next reading. NaN or non-positive
+    # readings are treated as missing.
+    history_fields = ParamEstTurbCtrlrBank.history_fields + ('od_meas', 'log_od_var', 'k_var', 'rejected')
+
+    def __init__(self, n, setpoint=0.0, init_od=1e-6, init_k=None, **bank_options):
+        super().__init__(n, setpoint, init_od, init_k, **bank_options)
+        self.meas_var = .02**2 # log od, per reading
+        self.meas_od_noise = .0054 # od (sd), per reading; robot_method takes it from the OD calibration
+        self.dilution_var = .015**2 # log od, per dilution; transfer volumes are not exact
+        self.k_drift_var = .05**2 # k (hr^-1)^2 per hour
+        self.outlier_gate = 4.0
+        self.max_rejects = 3
+        self.init_log_od_var = 100.0 # effectively unknown until the first reading
+        self.init_k_var = 1.0
+        self.log_od = np.log(self.od)
+        self.p_od = np.full(n, self.init_log_od_var) # var(log od)
+        self.p_cross = np.zeros(n) # cov(log od, k)
+        self.p_k = np.full(n, self.init_k_var) # var(k)
+        self.num_rejected = np.zeros(n, dtype=int) # consecutive rejections per well
+        self._step_mask = None
+
+    def covariance(self):
+        # (n, 2, 2): per-well covariance of (log od, k)
+        return np.stack((np.stack((self.p_od, self.p_cross), -1), np.stack((self.p_cross, self.p_k), -1)), -2)
+
+    def _predict(self, delta_time, prior_out):
+        dt = np.asarray(delta_time, dtype=float)/3600
+        self.log_od = self.log_od + self.k_estimate*dt - np.log1p(prior_out)
+        # P = F P F' + Q with F = [[1, dt], [0, 1]]
+        self.p_od = self.p_od + 2*dt*self.p_cross + dt*dt*self.p_k + np.where(prior_out > 0, self.dilution_var, 0)
+        self.p_cross = self.p_cross + dt*self.p_k
+        self.p_k = self.p_k + self.k_drift_var*np.abs(dt)
+
+    def _update(self, od_meas):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.log(od_meas)
+        innovation = z - self.log_od
+        # absolute noise taken at the larger of prediction and reading, so a first reading after a far-off prior
+        # still counts
+        od_ref = np.fmax(np.exp(self.log_od), od_meas)
+        meas_var = self.meas_var + (self.meas_od_noise/od_ref)**2
+        s = self.p_od + meas_var
+        measured = np.isfinite(innovation)
+        outlier = measured & (innovation*innovation > self.outlier_gate**2*s)
+        self.num_rejected = np.where(outlier, self.num_rejected + 1, np.where(measured, 0, self.num_rejected))
+        give_up = outlier & (self.num_rejected > self.max_rejects)
+        if give_up.any(): # trust the new level and relearn k
+            self.p_od = np.where(give_up, self.init_log_od_var, self.p_od)
+            self.p_cross = np.where(give_up, 0.0, self.p_cross)
+            self.p_k = np.where(give_up, self.init_k_var, self.p_k)
+            self.num_rejected[give_up] = 0
+            s = self.p_od + meas_var
+        use = measured & (~outlier | give_up)
+        gain_od, gain_k = self.p_od/s, self.p_cross/s
+        innovation = np.where(use, innovation, 0.0)
+        self.log_od = self.log_od + gain_od*innovation
+        self.k_estimate = self.k_estimate + gain_k*innovation
+        # P = (I - K H) P, skipped where the reading was not used
+        p_od, p_cross, p_k = self.p_od, self.p_cross, self.p_k
+        self.p_od = np.where(use, (1 - gain_od)*p_od, p_od)
+        self.p_cross = np.where(use, (1 - gain_od)*p_cross, p_cross)
+        self.p_k = np.where(use, p_k - gain_k*p_cross, p_k)
+        min_k, max_k = self.k_limits
+        self.k_estimate = np.clip(self.k_estimate, min_k, max_k)
+        return outlier & ~give_up
+
+    def _step(self, last_state, delta_time, od_meas, last_transfer_frac=None):
+        prior_od = last_state['od']
+        prior_out = last_state.get('output', np.zeros(self.n)) if last_transfer_frac is None else np.asarray(last_transfer_frac, dtype=float)
+        self._predict(delta_time, prior_out)
+        od_meas = np.full(self.n, np.nan) if od_meas is None else np.asarray(od_meas, dtype=float)
+        rejected = self._update(od_meas)
+        self.od = np.exp(self.log_od)
+        self._last_update = {'od_meas': od_meas, 'log_od_var': self.p_od.copy(), 'k_var': self.p_k.copy(),
+                'rejected': rejected.astype(float)}
+        s = self.approach_gain
+        transfer_vol_frac = (self.od*np.exp(delta_time/3600*self.k_estimate)
+                    /((self.setpoint*s + prior_od*(1-s))) - 1)
+        min_out, max_out = self.output_limits
+        return self._limit(transfer_vol_frac, min_out, max_out, nan_to=min_out)
+
+    _filter_fields = 'log_od', 'p_od', 'p_cross', 'p_k', 'num_rejected'
+
+    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None, mask=None):
+        # wells outside mask keep their filter state too, not just od and k_estimate
+        saved = {field: getattr(self, field) for field in self._filter_fields}
+        self._step_mask = None if mask is None else np.asarray(mask, dtype=bool)
+        transfer_vol_frac = super().step(delta_time, od_meas, last_transfer_vol_frac, mask)
+        if mask is not None:
+            for field, value in saved.items():
+                setattr(self, field, np.where(self._step_mask, getattr(self, field), value))
+        return transfer_vol_frac
+
+    def _record(self, row):
+        update = self._last_update
+        if self._step_mask is not None: # nothing was measured or rejected for wells outside the mask
+            update = {field: np.where(self._step_mask, value, 0.0 if field == 'rejected' else np.nan)
+                    for field, value in update.items()}
+        row.update(update)
+        super()._record(row)
+
+    def get_state(self):
+        state = super().get_state()
+        state.update({field: getattr(self, field).copy() for field in self._filter_fields})
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        if 'p_od' in state: # a checkpoint from ParamEstTurbCtrlrBank starts the filter from its od and k
+            for field in self._filter_fields:
+                setattr(self, field, np.array(state[field], dtype=getattr(self, field).dtype))
+        else:
+            self.log_od = np.log(self.od)
+
 if __name__ == '__main__':
     pass
 
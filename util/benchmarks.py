@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import types
+import numpy as np
+method_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if method_path not in sys.path:
+    sys.path.append(method_path)
+from turb_control import ParamEstTurbCtrlr, ParamEstTurbCtrlrBank, KalmanTurbCtrlrBank
+from meas_db import MeasurementStore
+from turbsim import BatchSimTurbidostats, batch_controllers
+import striplogs
+from od_calibration import read_plate_array, load_calibration
+
+# Usage: python benchmarks.py [results.json] [--quick] [--only name,name,...]
+# Times the controller, storage, log parsing and simulation paths at each well count in well_counts and writes
+# one JSON record per benchmark to results.json (default benchmark_results.json), along with the commit and
+# machine it ran on, so runs can be compared. --quick shrinks the workloads for a fast smoke run.
+
+well_counts = 24, 96, 384
+util_dir = os.path.dirname(os.path.abspath(__file__))
+quick = '--quick' in sys.argv
+scale = .1 if quick else 1
+repeats = 3
+cycle_time = 15*60
+
+def best_time(func, repeat=repeats):
+    # best of several runs, in seconds
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def od_readings(num_cycles, num_wells, rng):
+    return rng.uniform(.3, .6, (num_cycles, num_wells))
+
+def bench_controller_step(num_wells):
+    num_cycles = int(200*scale) or 1
+    readings = od_readings(num_cycles, num_wells, np.random.default_rng(0))
+    def scalar():
+        ctrlrs = [ParamEstTurbCtrlr(setpoint=.45, history_capacity=1) for _ in range(num_wells)]
+        for row in readings:
+            for ctrlr, od in zip(ctrlrs, row):
+                ctrlr.step(cycle_time, od)
+    def bank(bank_type=ParamEstTurbCtrlrBank):
+        ctrlrs = bank_type(num_wells, setpoint=.45, history_capacity=1)
+        for row in readings:
+            ctrlrs.step(cycle_time, row)
+    records = []
+    for name, func in (('controller_step_scalar', scalar), ('controller_step_bank', bank),
+            ('controller_step_kalman', lambda: bank(KalmanTurbCtrlrBank))):
+        seconds = best_time(func)
+        records.append({'name': name, 'wells': num_wells, 'cycles': num_cycles, 'seconds': seconds,
+                'per': 'cycle', 'seconds_per': seconds/num_cycles})
+    return records
+
+def bench_scrape_history(num_wells):
+    # a month of 15 minute cycles
+    num_cycles = int(30*24*4*scale)
+    readings = od_readings(num_cycles, num_wells, np.random.default_rng(1))
+    bank = ParamEstTurbCtrlrBank(num_wells, setpoint=.45)
+    for row in readings:
+        bank.step(cycle_time, row)
+    seconds = best_time(lambda: [bank.scrape_history(key) for key in ('od', 'output', 'k_estimate')])
+    return [{'name': 'scrape_history', 'wells': num_wells, 'cycles': num_cycles, 'seconds': seconds}]
+
+class BenchPlate:
+    # just enough of a pyhamilton plate for meas_db: 16 x 24 positions like a 384 well plate
+    def layout_name(self):
+        return 'bench_plate'
+    def position_id(self, idx):
+        return 'ABCDEFGHIJKLMNOP'[idx%16] + str(idx//16 + 1)
+
+class BenchPlateData:
+    def __init__(self, path, values):
+        self.path = path
+        self.header = types.SimpleNamespace(plate_ids=['bench'], time=None)
+        self.values = values
+
+def plate_datas(num_reads, num_wells, start_time, rng):
+    for i in range(num_reads):
+        read_time = time.localtime(start_time + i*cycle_time)
+        yield BenchPlateData('bench_' + time.strftime('%y%m%d_%H%M', read_time) + '.csv', rng.uniform(.05, .2, 384))
+
+def fill_db(db_path, num_reads, num_wells, start_time):
+    wells = list(range(num_wells))
+    with MeasurementStore(db_path) as store:
+        for plate_data in plate_datas(num_reads, num_wells, start_time, np.random.default_rng(2)):
+            # already parsed, as read_ods() hands it over; positions run down the 16 rows first
+            store.add_plate_data(plate_data, 'abs', BenchPlate(), wells, wells, plate_data.values.reshape(24, 16).T)
+
+def bench_db_insert(num_wells, tmp_dir):
+    num_reads = int(200*scale) or 1
+    db_path = os.path.join(tmp_dir, 'insert.db')
+    def insert():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        fill_db(db_path, num_reads, num_wells, time.time())
+    seconds = best_time(insert)
+    return [{'name': 'db_add_plate_data', 'wells': num_wells, 'reads': num_reads, 'seconds': seconds,
+            'per': 'plate read', 'seconds_per': seconds/num_reads}]
+
+def bench_plot_from_database(num_wells, tmp_dir):
+    # plot_from_database.py run as a script against a synthetic three week database, from scratch and then
+    # again after one more plate read is added
+    num_reads = int(3*7*24*4*scale)
+    local_dir = os.path.join(tmp_dir, 'method_local')
+    work_dir = os.path.join(tmp_dir, 'work')
+    for d in (local_dir, work_dir):
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+    db_path = os.path.join(local_dir, 'bench.db')
+    start_time = time.time() - num_reads*cycle_time
+    fill_db(db_path, num_reads, num_wells, start_time)
+    def run():
+        subprocess.run([sys.executable, os.path.join(util_dir, 'plot_from_database.py'), 'bench.db', '--no-plot'],
+                cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+    cold = best_time(run, repeat=1)
+    fill_db(db_path, 1, num_wells, start_time + num_reads*cycle_time)
+    warm = best_time(run, repeat=1)
+    return [{'name': 'plot_from_database_cold', 'wells': num_wells, 'reads': num_reads, 'seconds': cold},
+            {'name': 'plot_from_database_incremental', 'wells': num_wells, 'reads': num_reads + 1, 'seconds': warm}]
+
+def bench_plate_parse(num_wells, tmp_dir):
+    # one ClarioStar export parsed into an array and calibrated, as read_ods() does for every reader plate
+    num_rows = 8 if num_wells <= 96 else 16
+    path = os.path.join(tmp_dir, 'plate.csv')
+    with open(path, 'w') as f:
+        f.write('Testname: bench\nEnd_of_header\n\nChromatic: 1\nCycle: 1\nTime [s]: 0\n')
+        for i, reading in enumerate(np.random.default_rng(5).uniform(.05, .2, num_wells)):
+            f.write('{}{:02d}:\t    {:.4f}\n'.format('ABCDEFGHIJKLMNOP'[i//(num_wells//num_rows)], i%(num_wells//num_rows) + 1, reading))
+    calibration = load_calibration()
+    seconds = best_time(lambda: calibration.to_od(read_plate_array(path)), repeat=20)
+    return [{'name': 'plate_parse', 'wells': num_wells, 'seconds': seconds, 'per': 'plate read', 'seconds_per': seconds}]
+
+def write_log(path, num_cycles, num_wells, start_time, rng, mode='w'):
+    with open(path, mode) as f:
+        for i in range(num_cycles):
+            stamp = time.strftime('[%Y-%m-%d %H:%M:%S,000]', time.localtime(start_time + i*cycle_time))
+            f.write(stamp + ' root INFO tip_pick_up: Pick up tips at disposable_tips_0001, 1\n')
+            for token in striplogs.tokens:
+                f.write(stamp + ' root INFO ' + token + ' ' + str(rng.uniform(0, 1, num_wells).tolist()) + '\n')
+
+def bench_striplogs(num_wells, tmp_dir):
+    num_cycles = int(3*7*24*4*scale)
+    log_path = os.path.join(tmp_dir, 'main.log')
+    rng = np.random.default_rng(3)
+    write_log(log_path, num_cycles, num_wells, time.time() - num_cycles*cycle_time, rng)
+    striplogs.log_path = log_path
+    def fresh():
+        return 0, {token: ([], []) for token in striplogs.tokens}
+    cold = best_time(lambda: striplogs.read_new_lines(*fresh()))
+    offset, parsed = striplogs.read_new_lines(*fresh())
+    write_log(log_path, 1, num_wells, time.time(), rng, mode='a')
+    warm = best_time(lambda: striplogs.read_new_lines(offset, {token: (list(t), list(v)) for token, (t, v) in parsed.items()}))
+    return [{'name': 'striplogs_parse', 'wells': num_wells, 'cycles': num_cycles, 'bytes': os.path.getsize(log_path),
+                'seconds': cold},
+            {'name': 'striplogs_incremental', 'wells': num_wells, 'cycles': num_cycles + 1, 'seconds': warm}]
+
+def bench_turbsim(num_wells):
+    num_cycles = int(200*scale) or 1
+    num_replicates = 10
+    def run():
+        sim = BatchSimTurbidostats(batch_controllers(num_wells*num_replicates), 30*60, num_wells, num_replicates,
+                setpoint=.8, init_od=.3, growth_k=.9, seed=4)
+        sim.run(num_cycles)
+    seconds = best_time(run)
+    return [{'name': 'turbsim_batch', 'wells': num_wells, 'replicates': num_replicates, 'cycles': num_cycles,
+            'seconds': seconds, 'per': 'cycle', 'seconds_per': seconds/num_cycles}]
+
+# Seconds each module may take to import, over what numpy takes (every numeric module pays for numpy). Device
+# drivers and matplotlib are loaded on first use, so none of these should import them; sweeps and
+# simulations start a process per task and pay this every time.
+import_budget = {'turb_control': .05, 'turbsim': .05, 'pace_util': .05, 'virtual_clock': .02, 'adaptive_sampling': .05,
+        'meas_db': .05}
+
+def import_seconds(module):
+    # cumulative import time of module and of numpy within it, from python -X importtime in a fresh process
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], capture_output=True,
+            text=True, cwd=util_dir, env=dict(os.environ, PYTHONPATH=os.pathsep.join((method_path, util_dir))))
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times.setdefault(fields[2].strip(), int(fields[1])/1e6) # the first is the outermost import
+    if module not in times:
+        raise RuntimeError('Could not import ' + module + ':\n' + result.stderr[-2000:])
+    return times[module], times.get('numpy', 0.0)
+
+def bench_import_time():
+    records = []
+    for module, budget in import_budget.items():
+        seconds, numpy_seconds = min((import_seconds(module) for _ in range(repeats)), key=lambda t: t[0])
+        records.append({'name': 'import_' + module, 'wells': None, 'seconds': seconds, 'numpy_seconds': numpy_seconds,
+                'budget': budget, 'within_budget': seconds - numpy_seconds <= budget})
+    return records
+
+benchmarks = {
+    'controller_step': bench_controller_step,
+    'scrape_history': bench_scrape_history,
+    'db_add_plate_data': bench_db_insert,
+    'plot_from_database': bench_plot_from_database,
+    'striplogs': bench_striplogs,
+    'plate_parse': bench_plate_parse,
+    'turbsim': bench_turbsim,
+    'import_time': bench_import_time,
+}
+uses_tmp_dir = {'db_add_plate_data', 'plot_from_database', 'striplogs', 'plate_parse'}
+runs_once = {'import_time'} # does not depend on the number of wells
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=method_path, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    only = None
+    if '--only' in sys.argv:
+        only = sys.argv[sys.argv.index('--only') + 1].split(',')
+        args.remove(sys.argv[sys.argv.index('--only') + 1])
+    results_file = args[0] if args else 'benchmark_results.json'
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bench in benchmarks.items():
+            if only and name not in only:
+                continue
+            for num_wells in (None,) if name in runs_once else well_counts:
+                if name in runs_once:
+                    records = bench()
+                else:
+                    records = bench(num_wells, tmp_dir) if name in uses_tmp_dir else bench(num_wells)
+                for record in records:
+                    print('{:<32}{:>5} wells {:>10.4f} s'.format(record['name'], record['wells'] or '-', record['seconds'])
+                            + ('' if record.get('within_budget', True) else '  OVER BUDGET'))
+                results.extend(records)
+    with open(results_file, 'w') as f:
+        json.dump({'time': time.time(), 'commit': git_commit(), 'python': platform.python_version(),
+                'numpy': np.__version__, 'machine': platform.platform(), 'processor': platform.processor(),
+                'quick': quick, 'results': results}, f, indent=1)
+    print('wrote', results_file)
@@ -1,20 +1,41 @@
 import sqlite3
-import matplotlib.pyplot as plt
 from datetime import datetime
-import pdb
 import sys
 import os
+import pathlib
 import numpy as np
+method_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if method_path not in sys.path:
+    sys.path.append(method_path)
+from meas_db import meas_schema_version
+from od_calibration import load_calibration, parse_position
+
+# Usage: python plot_from_database.py [database name] [--no-plot] [--turbs N] [--reader NAME]
+# Readings are cached next to the database after the first run, so later runs only fetch rows added since,
+# and append just the new plate reads to out_<type>.csv. --no-plot skips drawing the figure.
+# Readings are grouped by lagoon (culture) number, since with several reader plates well names repeat.
+# --turbs sets how many lagoons to show; by default, as many as the database has.
+# Absorbance becomes OD through the --reader curves in assets/od_calibration.json ('default' if not given).
 
-number_of_turb = 96
 db_dir = os.path.join('..', 'method_local')
+start_time = datetime(2019, 7, 10, 11, 0).timestamp() # ignore readings before this
 
-if len(sys.argv) > 2:
+plot_on = '--no-plot' not in sys.argv
+number_of_turb = None
+args = sys.argv[1:]
+if '--turbs' in args:
+    number_of_turb = int(args.pop(args.index('--turbs') + 1))
+reader_name = 'default'
+if '--reader' in args:
+    reader_name = args.pop(args.index('--reader') + 1)
+calibration = load_calibration(reader_name)
+args = [arg for arg in args if not arg.startswith('--')]
+if len(args) > 1:
     print('Only (optional) argument is the name of the database you want to plot from')
     exit()
 dbs = [filename for filename in os.listdir(db_dir) if filename.split('.')[-1] == 'db']
-if len(sys.argv) == 2:
-    db_name = sys.argv[1]
+if len(args) == 1:
+    db_name = args[0]
     if db_name not in dbs:
         print('database does not exist in ' + db_dir)
         exit()
@@ -24,60 +45,125 @@ else:
         exit()
     db_name, = dbs
 
-conn = sqlite3.connect(os.path.join(db_dir, db_name))
-c = conn.cursor()
+def cache_path(type):
+    return os.path.join(db_dir, db_name + '.' + type + '.lagoons.plotcache.npz')
 
-for type in ['abs']:
-    scale = 2
-    table = []
-    fig1 = plt.figure(figsize=(24*scale, 16*scale))
-    subplot = 0
-    for column in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']:
-        for row in range(1,13):
-            subplot = subplot + 1
-            well = column + str(row)
-            
-            # set up plot
-            ax = fig1.add_subplot(8, number_of_turb/8, subplot)
-            ax.set_title("Lagoon" + well, x=0.5, y=0.8)
+def load_cache(type):
+    # flat arrays of every reading so far, plus bookkeeping for incremental fetch and export
+    try:
+        with np.load(cache_path(type)) as cache:
+            if 'plate_row' in cache.files: # caches from before per-well calibration are rebuilt
+                return {key: cache[key] for key in cache.files}
+    except (FileNotFoundError, ValueError):
+        pass
+    return {'last_rowid': np.array(0), 'exported_last': np.array(-np.inf), 'exported_readings': np.array(0),
+            'exported_wells': np.zeros(0, int),
+            'well_idx': np.zeros(0, int), 'timestamp': np.zeros(0), 'reading': np.zeros(0),
+            'plate_row': np.zeros(0, int), 'plate_col': np.zeros(0, int)}
+
+def fetch_new(c, type, cache):
+    # one query for all lagoons; rowid is the table's primary key, so the rowid range is what keeps it to the
+    # rows added since the last fetch
+    c.execute('''SELECT rowid, lagoon_number, timestamp, reading, well FROM measurements
+                 WHERE data_type=? AND rowid>? AND timestamp>? AND filename NOT LIKE '%dummy%' ''',
+              (type, int(cache['last_rowid']), start_time))
+    rows = c.fetchall()
+    print(len(rows), 'new entries fetched')
+    if not rows:
+        return cache
+    rowids, new_lagoons, timestamps, readings, wells = zip(*rows)
+    new_well_idx = np.array([-1 if lagoon is None else lagoon for lagoon in new_lagoons], int)
+    keep = new_well_idx >= 0
+    plate_rows, plate_cols = np.array([parse_position(well) for well in wells], int).reshape(-1, 2).T
+    cache = dict(cache)
+    cache['last_rowid'] = np.array(max(rowids))
+    cache['well_idx'] = np.concatenate((cache['well_idx'], new_well_idx[keep]))
+    cache['timestamp'] = np.concatenate((cache['timestamp'], np.array(timestamps, float)[keep]))
+    cache['reading'] = np.concatenate((cache['reading'], np.array(readings, float)[keep]))
+    cache['plate_row'] = np.concatenate((cache['plate_row'], plate_rows[keep]))
+    cache['plate_col'] = np.concatenate((cache['plate_col'], plate_cols[keep]))
+    # group by well, time-ordered within each well
+    order = np.lexsort((cache['timestamp'], cache['well_idx']))
+    for key in ('well_idx', 'timestamp', 'reading', 'plate_row', 'plate_col'):
+        cache[key] = cache[key][order]
+    return cache
 
-            n = (well, type, )
-            c.execute('SELECT filename, well, reading FROM measurements WHERE well=? AND data_type=?', n)
-   
-            x = c.fetchall()
-            print(len(x), "entries fetched")
-            #pdb.set_trace()
-            vals = [(datetime.strptime(f[-15:-4], '%y%m%d_%H%M'), w, v) for (f, w, v) in x if 'dummy' not in f]
-            #pdb.set_trace()
-            vals = [(t, w, v) for t, w, v in vals if t > datetime(2019, 7, 10, 11, 0)] 
-    
-            #assert w == well, "Recorded lagoon " + str(w) + " not equal to expected lagoon well" + str(well)
+def to_od(cache):
+    # every reading at once, each through the curve for the reader well it was read in
+    return calibration.to_od_at(cache['reading'], cache['plate_row'], cache['plate_col'])
 
-            times = [t for (t, _, _) in vals]
-            ys = [5.40541*data_val - 0.193514 for (j, _, data_val) in vals]
-            plt.plot(times, ys, 'b.-')
-    
-            if type == 'abs':
-                plt.ylim(0.0, 2.5)
-            else:
-                plt.ylim(450, 4000.0)
-                #plt.ylim(0, 500.0)
-        
-            # decrease number of plotted X axis labels
-            # make there be fewer labels so that you can read them
-            
-            deltas = [t - times[0] for t in times]
-            labels = [int(d.seconds/60/60 + d.days*24) for d in deltas]
-            labels_sparse = [labels[x] if x % 6 == 0 else '' for x in range(len(labels))]
-            plt.xticks(times, labels_sparse)
-            locs, labels = plt.xticks()
-            if ys:
-                table.append(ys)
-    table = np.array(table)
+def per_well(cache, ods):
+    bounds = np.searchsorted(cache['well_idx'], np.arange(number_of_turb + 1))
+    return [(cache['timestamp'][a:b], ods[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def export_csv(type, cache, ods):
+    # One line per plate read, one column per well that has data. Only reads newer than the last exported one are
+    # appended. The file is rewritten if the set of wells changed, or if a reading turned up at or before the last
+    # exported time (then the count of readings up to that time no longer matches what was written).
+    out_file = 'out_' + str(type) + '.csv'
+    present = np.unique(cache['well_idx'])
+    times = np.unique(cache['timestamp'])
+    last = float(cache.get('exported_last', -np.inf))
+    rewrite = (not np.array_equal(present, cache['exported_wells']) or not os.path.exists(out_file)
+               or np.count_nonzero(cache['timestamp'] <= last) != int(cache.get('exported_readings', -1)))
+    if rewrite:
+        last = -np.inf
+    new_times = times[times > last]
+    if not len(new_times):
+        return cache
+    table = np.full((len(new_times), len(present)), np.nan)
+    new = cache['timestamp'] > last
+    table[np.searchsorted(new_times, cache['timestamp'][new]),
+          np.searchsorted(present, cache['well_idx'][new])] = ods[new]
+    with open(out_file, 'w+' if rewrite else 'a') as f:
+        for row in table:
+            f.write(','.join((str(rowel) for rowel in row)) + '\n')
+    cache = dict(cache)
+    cache.pop('exported_times', None)
+    cache['exported_last'] = np.array(new_times[-1])
+    cache['exported_readings'] = np.array(len(cache['timestamp']))
+    cache['exported_wells'] = present
+    return cache
+
+def plot(type, series):
+    import matplotlib.pyplot as plt
+    scale = 2
+    rows = 8 if number_of_turb <= 96 else 16
+    columns = -(-number_of_turb//rows)
+    fig1 = plt.figure(figsize=(2*columns*scale, 2*rows*scale))
+    for lagoon, (times, ods) in enumerate(series):
+        ax = fig1.add_subplot(rows, columns, lagoon + 1)
+        ax.set_title("Lagoon " + str(lagoon), x=0.5, y=0.8)
+        hours = (times - times[0])/3600 if len(times) else times
+        ax.plot(hours, ods, 'b.-')
+        if type == 'abs':
+            ax.set_ylim(0.0, 2.5)
+        else:
+            ax.set_ylim(450, 4000.0)
     fig1.tight_layout()
     plt.savefig(os.path.join(db_dir, 'plot_' + type + ".png"), dpi = 200)
-    with open('out_' + str(type) + '.csv', 'w+') as f:
-        for row in np.transpose(table):
-            f.write(','.join((str(rowel) for rowel in row)) + '\n')
 
-conn.close()
\ No newline at end of file
+# read-only, so plotting never changes a database, even a live run's
+db_path = os.path.join(db_dir, db_name)
+conn = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + '?mode=ro', uri=True)
+c = conn.cursor()
+if not c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='measurements'").fetchone():
+    print(db_name + ' has no measurements')
+    exit()
+if c.execute('PRAGMA user_version').fetchone()[0] < meas_schema_version:
+    print(db_name + ' is from an older version of the method; upgrade it with: python ' + os.path.join('..', 'meas_db.py') + ' ' + db_path)
+    exit()
+
+if number_of_turb is None:
+    c.execute('SELECT MAX(lagoon_number) FROM measurements')
+    number_of_turb = (c.fetchone()[0] or 0) + 1
+
+for type in ['abs']:
+    cache = fetch_new(c, type, load_cache(type))
+    ods = to_od(cache)
+    cache = export_csv(type, cache, ods)
+    np.savez(cache_path(type), **cache)
+    if plot_on:
+        plot(type, per_well(cache, ods))
+
+conn.close()
@@ -1,44 +1,123 @@
 import datetime as dt
-from matplotlib import pyplot as plt
+import numpy as np
+import sys
 import os
+method_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if method_path not in sys.path:
+    sys.path.append(method_path)
+from telemetry import load_telemetry, quantity_table
 
-with open(os.path.join('..', 'method_local', 'log', 'main.log')) as f:
-    lines = [l for l in f]
-def plot_lists(token):
-    split_token = ' root INFO ' + token + ' '
-    contiguous_blocks = [[]]
-
-    last_time = start_time = None
-    for line in lines:
-        if split_token in line:
-            time_str, data = line.split(split_token)
-            time = dt.datetime.strptime(time_str, '[%Y-%m-%d %H:%M:%S,%f]')
-            #if last_time:
-            #    print((time - last_time).seconds)
-            if last_time and (time - last_time).seconds > 30*60:
-                contiguous_blocks.append([])
-            current_block = contiguous_blocks[-1]
-            #print(current_block)
-            if not current_block:
-                print(len(current_block))
-                start_time = time
-            delta_time = time - start_time
-            current_block.append((delta_time.seconds/3600+delta_time.days*24, eval(data)))
-            last_time = time
-
-    #print(contiguous_blocks[-1])
-    #print(len(contiguous_blocks))
-    #print(time)
-    #print(start_time)
+# Pulls the per-well lists that robot_method logs each cycle out of main.log. Parsed values and the byte
+# offset reached are kept in main.log.strip.npz, so each run only reads lines appended since the last one.
+# If the method wrote a telemetry (.tlm) file, the same series are read straight from that instead.
+
+method_local_dir = os.path.join('..', 'method_local')
+log_path = os.path.join(method_local_dir, 'log', 'main.log')
+state_path = log_path + '.strip.npz'
+tokens = 'CONVERTED OD READINGS', 'FLOW RATES', 'K ESTIMATES', 'OD ESTIMATES', 'REPLACEMENT VOLUMES'
+plot_tokens = 'OD ESTIMATES', 'K ESTIMATES', 'REPLACEMENT VOLUMES'
+telemetry_quantities = {'CONVERTED OD READINGS': 'od_reading', 'FLOW RATES': 'flow_rate',
+        'K ESTIMATES': 'k_estimate', 'OD ESTIMATES': 'od_estimate', 'REPLACEMENT VOLUMES': 'replace_vol'}
+split_marker = ' root INFO '
+max_gap = 30*60 # seconds between entries that starts a new contiguous block
+
+def parse_list(data):
+    # '[0.1, 0.2, nan]' -> [0.1, 0.2, nan], without eval
+    data = data.strip()
+    if data.startswith('[') and data.endswith(']'):
+        data = data[1:-1]
+    return [float(x) for x in data.split(',')] if data.strip() else []
+
+def parse_time(time_str):
+    # '[2019-07-11 12:00:00,123]' -> seconds since the epoch
+    return dt.datetime.fromisoformat(time_str.strip()[1:-1].replace(',', '.')).timestamp()
+
+def load_state():
+    if not os.path.exists(state_path):
+        return 0, {token: ([], []) for token in tokens}
+    with np.load(state_path) as state:
+        parsed = {}
+        for i, token in enumerate(tokens):
+            times, values, lengths = (state[name + '_' + str(i)] for name in ('times', 'values', 'lengths'))
+            parsed[token] = (times.tolist(), [row[:length].tolist() for row, length in zip(values, lengths)])
+        return int(state['offset']), parsed
+
+def pad_table(values):
+    # lists as rows of a 2D array, padded with NaN to the longest list
+    width = max((len(v) for v in values), default=0)
+    table = np.full((len(values), width), np.nan)
+    for row, v in zip(table, values):
+        row[:len(v)] = v
+    return table
+
+def save_state(offset, parsed):
+    arrays = {'offset': np.array(offset)}
+    for i, token in enumerate(tokens):
+        times, values = parsed[token]
+        arrays['times_' + str(i)] = np.array(times, float)
+        arrays['values_' + str(i)] = pad_table(values)
+        arrays['lengths_' + str(i)] = np.array([len(v) for v in values], int)
+    np.savez(state_path, **arrays)
+
+def read_new_lines(offset, parsed):
+    # One pass over the unread part of the log, picking up every token at once
+    split_tokens = [(split_marker + token + ' ', token) for token in tokens]
+    if os.path.getsize(log_path) < offset: # log was truncated or replaced, start over
+        offset, parsed = 0, {token: ([], []) for token in tokens}
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        for raw_line in f:
+            if not raw_line.endswith(b'\n'):
+                break # partially written line, pick it up next time
+            offset += len(raw_line)
+            line = raw_line.decode(errors='replace')
+            if split_marker not in line:
+                continue
+            for split_token, token in split_tokens:
+                if split_token in line:
+                    time_str, data = line.split(split_token, 1)
+                    try:
+                        values = parse_list(data)
+                    except ValueError:
+                        break
+                    times, value_lists = parsed[token]
+                    times.append(parse_time(time_str))
+                    value_lists.append(values)
+                    break
+    return offset, parsed
+
+def last_block(times, values):
+    # entries after the last gap longer than max_gap, with times as hours since the start of the block
+    times = np.array(times)
+    if not len(times):
+        return times, values
+    gaps = np.nonzero(np.diff(times) > max_gap)[0]
+    start = gaps[-1] + 1 if len(gaps) else 0
+    return (times[start:] - times[start])/3600, values[start:]
+
+def plot_lists(token, times, values):
+    from matplotlib import pyplot as plt
+    hours, block = last_block(times, values)
     plt.figure(token)
-    plt.plot(*zip(*contiguous_blocks[-1]))
+    if len(hours):
+        plt.plot(hours, pad_table(block))
     with open(token + '.csv', 'w+') as csv:
-        for line in contiguous_blocks[-1]:
-            csv.write(','.join((str(w) for w in line)).replace(']', '').replace('[', '') + '\n')
+        for hour, v in zip(hours, block):
+            csv.write(','.join([str(hour)] + [str(w) for w in v]) + '\n')
     plt.savefig(token + '.pdf')
 
+def read_telemetry(path):
+    records = load_telemetry(path)
+    return {token: quantity_table(records, telemetry_quantities[token]) for token in tokens}
 
-for token in 'OD ESTIMATES', 'K ESTIMATES', 'REPLACEMENT VOLUMES':
-    plot_lists(token)
-    
-plt.show()
+if __name__ == '__main__':
+    from matplotlib import pyplot as plt
+    telemetry_files = [f for f in os.listdir(method_local_dir) if f.endswith('.tlm')]
+    if len(telemetry_files) == 1:
+        parsed = read_telemetry(os.path.join(method_local_dir, telemetry_files[0]))
+    else:
+        offset, parsed = read_new_lines(*load_state())
+        save_state(offset, parsed)
+    for token in plot_tokens:
+        plot_lists(token, *parsed[token])
+    plt.show()
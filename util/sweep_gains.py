@@ -0,0 +1,98 @@
+import os
+import sys
+import csv
+import json
+import zlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from turbsim import BatchSimTurbidostats, batch_controllers
+
+# Usage: python sweep_gains.py [grid.json] [results.csv]
+# grid.json maps each parameter below to a list of values to try; missing parameters keep their defaults.
+# Every combination is simulated in a separate process. Rows already in results.csv are skipped, so an
+# interrupted sweep picks up where it left off when rerun with the same arguments.
+
+default_grid = {
+    'k_gain': [.05, .1, .15, .25, .4],
+    'approach_gain': [.3, .5, .7, .9, 1.0],
+    'output_limits': [[.05, .68]],
+    'k_limits': [[.05, 5]],
+    'cycle_time': [15*60, 30*60], # seconds
+    'growth_k': [[.1, .9], [.5, 1.0]], # growth rates drawn uniformly from this range, hr^-1
+}
+setpoint = .45
+num_wells = 24
+num_replicates = 20
+num_hours = 72
+settle_tolerance = .1 # fraction of setpoint
+metric_names = ['settling_time_hr', 'od_rms_error', 'media_per_culture_day', 'saturation_frac']
+
+def grid_points(grid):
+    names = sorted(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+def point_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def run_point(params):
+    # Simulate one grid point and summarize it. Seeded from the parameters so reruns are reproducible.
+    rng = np.random.default_rng(zlib.crc32(point_key(params).encode()))
+    shape = num_replicates, num_wells
+    controllers = batch_controllers(num_wells*num_replicates)
+    controllers.k_gain = params['k_gain']
+    controllers.approach_gain = params['approach_gain']
+    controllers.k_limits = tuple(params['k_limits'])
+    sim = BatchSimTurbidostats(controllers, params['cycle_time'], num_wells, num_replicates, setpoint=setpoint,
+            init_od=rng.uniform(.01, .41, shape), growth_k=rng.uniform(*params['growth_k'], shape),
+            seed=rng.integers(2**32))
+    sim.set_output_limits(*params['output_limits'])
+    num_cycles = int(num_hours*3600/params['cycle_time'])
+    true_ods, _, outputs = sim.run(num_cycles)
+
+    cycle_hrs = params['cycle_time']/3600
+    out_of_band = np.abs(true_ods - setpoint) > settle_tolerance*setpoint
+    # settled after the last out-of-band cycle; cultures that end out of band never settled
+    last_out = num_cycles - 1 - np.argmax(out_of_band[::-1], axis=0)
+    settling_cycles = np.where(out_of_band.any(axis=0), last_out + 1, 0).astype(float)
+    settling_cycles[out_of_band[-1]] = np.nan
+    min_out, max_out = params['output_limits']
+    saturated = np.isclose(outputs, min_out) | np.isclose(outputs, max_out)
+    return {
+        'settling_time_hr': float(np.nanmedian(settling_cycles)*cycle_hrs) if not np.isnan(settling_cycles).all() else float('nan'),
+        'od_rms_error': float(np.sqrt(np.mean((true_ods - setpoint)**2))),
+        'media_per_culture_day': float(outputs.sum(axis=0).mean()/num_hours*24), # in culture volumes
+        'saturation_frac': float(saturated.mean()),
+    }
+
+def done_keys(results_file):
+    if not os.path.exists(results_file):
+        return set()
+    with open(results_file) as f:
+        return {row['params'] for row in csv.DictReader(f)}
+
+if __name__ == '__main__':
+    grid = dict(default_grid)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            grid.update(json.load(f))
+    results_file = sys.argv[2] if len(sys.argv) > 2 else 'sweep_results.csv'
+    param_names = sorted(grid)
+    finished = done_keys(results_file)
+    todo = [params for params in grid_points(grid) if point_key(params) not in finished]
+    print(len(finished), 'grid points already done,', len(todo), 'to go')
+
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a', newline='') as f, ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['params'] + param_names + metric_names)
+        futures = {pool.submit(run_point, params): params for params in todo}
+        for i, future in enumerate(as_completed(futures)):
+            params = futures[future]
+            metrics = future.result()
+            writer.writerow([point_key(params)] + [json.dumps(params[name]) for name in param_names]
+                    + [metrics[name] for name in metric_names])
+            f.flush() # every finished row survives an interruption
+            print(i + 1, '/', len(todo), params, metrics)
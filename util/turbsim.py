@@ -4,12 +4,11 @@ turb_ctrl_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if turb_ctrl_path not in sys.path:
     sys.path.append(turb_ctrl_path)
 
-from turb_control import ParamEstTurbCtrlr
+from turb_control import ParamEstTurbCtrlr, ParamEstTurbCtrlrBank, KalmanTurbCtrlrBank
+from virtual_clock import VirtualClock
 import numpy as np
-import matplotlib.pyplot as plt
 import random
 import time
-import threading
 
 class SimTurbidostat:
     def __init__(self, controller, cycle_time, setpoint=0.0, init_od=0.0, growth_k=2.08): # commonly cited double every 20 minutes
@@ -19,11 +18,9 @@ class SimTurbidostat:
         controller.output_limits = .05, .68
         controller.setpoint = setpoint
         self.controller = controller
-        self.wait_thread = None
 
     def update(self, realtime=False):
-        if self.wait_thread: # use threading for delays to allow multiple simultaneous real-time simulations
-            self.wait_thread.join()
+        # with realtime, the controller measures elapsed time itself (on its clock) rather than being told cycle_time
         # grow culture
         self.od = self.od*np.exp(self.cycle_time/3600*self.growth_k)
         delta_time = None if realtime else self.cycle_time
@@ -36,9 +33,6 @@ class SimTurbidostat:
         actual_transfer_vol_frac = transfer_vol_frac + (random.random()*2-1)*.02
         # dilute according to command
         self.od = self.od/(1+actual_transfer_vol_frac)
-        if realtime:
-            self.wait_thread = threading.Thread(target=lambda: time.sleep(cycle_time))
-            self.wait_thread.start() 
 
     def set_k(self, k):
         self.growth_k = k
@@ -46,60 +40,162 @@ class SimTurbidostat:
     def set_od(self, od):
         self.od = od
 
+class BatchSimTurbidostats:
+    # Vectorized SimTurbidostat: num_replicates independent runs of num_wells cultures, all advanced with
+    # array operations. Ground truth arrays have shape (num_replicates, num_wells). The controller is either a
+    # ParamEstTurbCtrlrBank of size num_replicates*num_wells or a flat list of that many scalar TurbControllers.
+    def __init__(self, controller, cycle_time, num_wells, num_replicates=1, setpoint=0.0, init_od=0.0,
+            growth_k=2.08, seed=None):
+        self.cycle_time = cycle_time # in seconds
+        self.shape = num_replicates, num_wells
+        self.growth_k = np.broadcast_to(np.asarray(growth_k, dtype=float), self.shape).copy() # hrs^-1
+        self.od = np.broadcast_to(np.asarray(init_od, dtype=float), self.shape).copy()
+        self.rng = np.random.default_rng(seed)
+        self.controller = controller
+        self.set_output_limits(.05, .68)
+        self.set_setpoint(setpoint)
+
+    def _controllers(self):
+        return [self.controller] if isinstance(self.controller, ParamEstTurbCtrlrBank) else self.controller
+
+    def set_output_limits(self, min_out, max_out):
+        for controller in self._controllers():
+            controller.output_limits = min_out, max_out
+
+    def set_setpoint(self, setpoint):
+        # scalar, per-well (num_wells,) or per-culture (num_replicates, num_wells)
+        setpoint = np.broadcast_to(np.asarray(setpoint, dtype=float), self.shape).ravel()
+        if isinstance(self.controller, ParamEstTurbCtrlrBank):
+            self.controller.setpoint = setpoint.copy()
+        else:
+            for controller, sp in zip(self.controller, setpoint):
+                controller.setpoint = sp
+
+    def _step_controller(self, od_meas):
+        od_meas = od_meas.ravel()
+        if isinstance(self.controller, ParamEstTurbCtrlrBank):
+            transfer_vol_frac = self.controller.step(self.cycle_time, od_meas)
+        else:
+            transfer_vol_frac = np.array([c.step(self.cycle_time, od) for c, od in zip(self.controller, od_meas)])
+        return transfer_vol_frac.reshape(self.shape)
+
+    def update(self):
+        # grow culture
+        self.od = self.od*np.exp(self.cycle_time/3600*self.growth_k)
+        meas_noise = 1/(1+self.rng.random(self.shape)*10000) # Occasional very large spikes, as when clumps occlude sensor
+        od_meas = self.od + meas_noise
+        transfer_vol_frac = self._step_controller(od_meas)
+        # add mechanical/operational noise
+        actual_transfer_vol_frac = transfer_vol_frac + (self.rng.random(self.shape)*2-1)*.02
+        # dilute according to command
+        self.od = self.od/(1+actual_transfer_vol_frac)
+        return od_meas, transfer_vol_frac
+
+    def run(self, num_cycles, setpoint_schedule=None):
+        # Returns ground truth od, measured od and commanded transfer volume fraction, each (num_cycles, num_replicates, num_wells).
+        # setpoint_schedule(cycle) may return a new setpoint for that cycle, or None to keep the current one.
+        true_ods, meas_ods, outputs = (np.empty((num_cycles,) + self.shape) for _ in range(3))
+        for i in range(num_cycles):
+            if setpoint_schedule is not None:
+                setpoint = setpoint_schedule(i)
+                if setpoint is not None:
+                    self.set_setpoint(setpoint)
+            meas_ods[i], outputs[i] = self.update()
+            true_ods[i] = self.od
+        return true_ods, meas_ods, outputs
+
+def batch_controllers(num_cultures, vectorized=True, kalman=False, **ctrlr_options):
+    # history is kept by BatchSimTurbidostats.run(), so the controllers only need their latest state
+    if kalman:
+        return KalmanTurbCtrlrBank(num_cultures, history_capacity=1, **ctrlr_options)
+    if vectorized:
+        return ParamEstTurbCtrlrBank(num_cultures, history_capacity=1, **ctrlr_options)
+    return [ParamEstTurbCtrlr(history_capacity=1, **ctrlr_options) for _ in range(num_cultures)]
+
 def rand_between(a, b):
     return min(a,b) + random.random()*abs(b-a)
 
 realtime = sys.argv[1] == '--realtime' if len(sys.argv) > 1 else False
+paced = '--paced' in sys.argv # with --realtime, show each cycle in paced_cycle_time of wall-clock time
+batch = sys.argv[1] == '--batch' if len(sys.argv) > 1 else False
 
 if __name__ == '__main__':
+    import asyncio
+    import matplotlib.pyplot as plt # only the script plots; importing this module for its classes stays fast
     normal_cycle_time = 30*60 # 30 mins in seconds
-    if realtime:
-        cycle_time = .1
-    else:
-        cycle_time = normal_cycle_time
+    cycle_time = normal_cycle_time
+    paced_cycle_time = .1
+
+    if batch: # python turbsim.py --batch [num_replicates] [--kalman]
+        num_replicates = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else 100
+        num_wells, num_cycles = 24, 200
+        rng = np.random.default_rng()
+        batch_sim = BatchSimTurbidostats(batch_controllers(num_wells*num_replicates, kalman='--kalman' in sys.argv), normal_cycle_time,
+                num_wells, num_replicates, setpoint=.8, init_od=rng.uniform(.1*.66, .8*.66, (num_replicates, num_wells)),
+                growth_k=rng.uniform(.92, .93, (num_replicates, num_wells)), seed=rng.integers(2**32))
+        tooth_size = 40
+        def tooth_setpoint(i):
+            if i % tooth_size == 0:
+                return (i%(tooth_size*2)/tooth_size)*(.02+rng.uniform(0, .06))+.8
+        start = time.time()
+        true_ods, meas_ods, outputs = batch_sim.run(num_cycles, tooth_setpoint)
+        print('simulated', num_wells*num_replicates*num_cycles*normal_cycle_time/3600/24, 'culture-days in',
+                time.time() - start, 'seconds')
+        xs = np.arange(num_cycles)*normal_cycle_time/3600
+        plt.plot(xs, true_ods[:, 0])
+        plt.figure()
+        plt.plot(xs, outputs[:, 0])
+        plt.show()
+        sys.exit()
 
     xs = []
-    sim_turbs = [SimTurbidostat(ParamEstTurbCtrlr(), cycle_time) for _ in range(24)]
+    clock = VirtualClock() # realtime controllers read this instead of time.time()
+    sim_turbs = [SimTurbidostat(ParamEstTurbCtrlr(clock=clock), cycle_time) for _ in range(24)]
 
     def get_history(turb, key):
-        return [state.get(key, 0) for state in turb.controller.history()]
+        return turb.controller.scrape_history(key, fill_value=0)
 
     def plotem():
         od_courses, output_courses, k_courses = ([st.controller.scrape_history(key) for st in sim_turbs] for key in ('od', 'output', 'k_estimate'))
         print(k_courses)
-        plt.plot(xs, list(zip(*od_courses)))
+        plt.plot(xs, np.transpose(od_courses))
         plt.figure()
-        plt.plot(xs, list(zip(*output_courses)))
+        plt.plot(xs, np.transpose(output_courses))
         plt.figure()
-        plt.plot(xs, list(zip(*k_courses)))
+        plt.plot(xs, np.transpose(k_courses))
         plt.show()
 
     for w, sim_turb in enumerate(sim_turbs):
         sim_turb.setpoint = .8
         sim_turb.set_od(rand_between(.1*.66, .8*.66))
-        scale = normal_cycle_time*10 if realtime else 1
-        if realtime:
-            sim_turb.controller.k_limits = .05, 25000
-        sim_turb.set_k(rand_between(.92*scale, .93*scale))
+        sim_turb.set_k(rand_between(.92, .93))
         # if w < 12:
-        #     sim_turb.set_k(rand_between(1.3*scale, 1.5*scale))
+        #     sim_turb.set_k(rand_between(1.3, 1.5))
         # else:
-        #     sim_turb.set_k(rand_between(1.8*scale, 2.08*scale))
+        #     sim_turb.set_k(rand_between(1.8, 2.08))
 
-    for i in range(100 if realtime else 200):
-        try:
-            xs.append(i*normal_cycle_time/3600)
-            tooth_size = 40
-            if i % tooth_size == 0:
-                tooth_height = .02+rand_between(0,.06)
-                for w, sim_turb in enumerate(sim_turbs):
-                    sim_turb.controller.setpoint = (i%(tooth_size*2)/tooth_size)*tooth_height+.8
-                    print((i%(tooth_size*2)/tooth_size)*tooth_height+.4)
-            for sim_turb in sim_turbs:
-                sim_turb.update(realtime=realtime)
-            print('cycle:', i)
-            #time.sleep(cycle_time/sim_time_dilation)
-        except KeyboardInterrupt:
-            import pdb; pdb.set_trace()
+    num_cycles = 100 if realtime else 200
+    def run_cycle(i):
+        xs.append(i*normal_cycle_time/3600)
+        tooth_size = 40
+        if i % tooth_size == 0:
+            tooth_height = .02+rand_between(0,.06)
+            for w, sim_turb in enumerate(sim_turbs):
+                sim_turb.controller.setpoint = (i%(tooth_size*2)/tooth_size)*tooth_height+.8
+                print((i%(tooth_size*2)/tooth_size)*tooth_height+.4)
+        for sim_turb in sim_turbs:
+            sim_turb.update(realtime=realtime)
+        print('cycle:', i)
+        if i + 1 < num_cycles:
+            clock.schedule(cycle_time, run_cycle, i + 1)
+
+    clock.schedule(cycle_time, run_cycle, 0)
+    try:
+        if realtime and paced:
+            asyncio.run(clock.run_paced(speed=cycle_time/paced_cycle_time))
+        else:
+            clock.run()
+    except KeyboardInterrupt:
+        import pdb; pdb.set_trace()
 
     plotem()
@@ -1,5 +1,6 @@
 from turbsim import SimTurbidostat, ParamEstTurbCtrlr
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 
 xs = sim_turbs = ods = None
@@ -20,13 +21,13 @@ def plotem():
         plt.plot(odcs, opcs)
     plt.figure()
     plt.gca().set_prop_cycle(None)
-    plt.plot(xs, list(zip(*k_est_courses)))
+    plt.plot(xs, np.transpose(k_est_courses))
     plt.figure()
     plt.gca().set_prop_cycle(None)
-    plt.plot(xs, list(zip(*od_courses)))
+    plt.plot(xs, np.transpose(od_courses))
     plt.figure()
     plt.gca().set_prop_cycle(None)
-    plt.plot(xs, list(zip(*output_courses)))
+    plt.plot(xs, np.transpose(output_courses))
     plt.show()
 
 reinit()
@@ -0,0 +1,85 @@
+import heapq
+import itertools
+import time
+
+class VirtualClock:
+    # Discrete-event scheduler with its own notion of time, in seconds. Callbacks run in time order and the
+    # clock jumps straight to each one, so simulated hours pass as fast as the callbacks execute.
+    # Has the same time()/sleep() interface as ScaledClock and the time module, and an instance is callable and
+    # returns the current virtual time, so either can be handed to anything that would otherwise call
+    # time.time(), e.g. TurbController(clock=...).
+    def __init__(self, start_time=0.0):
+        self._now = start_time
+        self._events = []
+        self._seq = itertools.count() # tie-breaker, keeps same-time events in scheduling order
+
+    def time(self):
+        return self._now
+
+    now = time
+
+    def __call__(self):
+        return self._now
+
+    def schedule_at(self, event_time, callback, *args):
+        heapq.heappush(self._events, (max(event_time, self._now), next(self._seq), callback, args))
+
+    def schedule(self, delay, callback, *args):
+        self.schedule_at(self._now + delay, callback, *args)
+
+    def pending(self):
+        return len(self._events)
+
+    def next_event_time(self):
+        return self._events[0][0] if self._events else None
+
+    def run_next(self):
+        if not self._events:
+            return False
+        self._now, _, callback, args = heapq.heappop(self._events)
+        callback(*args)
+        return True
+
+    def run(self, until=None):
+        # run events (including any they schedule) until none are left or the next one is after `until`
+        while self._events and (until is None or self._events[0][0] <= until):
+            self.run_next()
+        if until is not None:
+            self._now = max(self._now, until)
+
+    def sleep(self, duration):
+        # stand-in for time.sleep(): advances virtual time, running whatever is due in the meantime
+        self.run(until=self._now + duration)
+
+    async def run_paced(self, speed=1.0, until=None):
+        # Like run(), but waits in wall-clock time between events, at `speed` virtual seconds per real second.
+        # Useful for live demos; other asyncio tasks keep running while it waits.
+        import asyncio # already loaded by whoever runs the event loop; not imported with this module
+        wall_start, virtual_start = time.monotonic(), self._now
+        def wait_until(virtual_time):
+            return asyncio.sleep(max(0, wall_start + (virtual_time - virtual_start)/speed - time.monotonic()))
+        while self._events and (until is None or self._events[0][0] <= until):
+            await wait_until(self._events[0][0])
+            self.run_next()
+        if until is not None and until > self._now:
+            await wait_until(until) # the clock reaches until in paced time too
+            self._now = until
+
+class ScaledClock:
+    # Wall-clock time sped up by a constant factor, for running threaded code (e.g. the whole robot method
+    # against digital_twin devices) faster than real time. time() starts at the real time of creation and
+    # advances `speed` seconds per real second; sleep() waits 1/speed as long. Has the same time()/sleep()
+    # interface as the time module, so either can be passed where a clock is expected.
+    def __init__(self, speed=1.0, start_time=None):
+        self.speed = speed
+        self.start_time = time.time() if start_time is None else start_time
+        self._wall_start = time.monotonic()
+
+    def time(self):
+        return self.start_time + (time.monotonic() - self._wall_start)*self.speed
+
+    def __call__(self):
+        return self.time()
+
+    def sleep(self, duration):
+        time.sleep(max(0, duration)/self.speed)